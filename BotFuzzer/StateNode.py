@@ -1,10 +1,12 @@
 import json
 import os
 
-from PIL import Image, UnidentifiedImageError
 from anytree import NodeMixin
 from actions import ActionFactory, BaseTelegramAction
-from moviepy.editor import VideoFileClip
+from media import PendingMedia
+
+# text inputs made up by the tester rather than offered by the bot's keyboard
+TYPED_INPUT_KINDS = ('send_ai_text_message', 'send_random_text_message')
 
 
 class StateNode(NodeMixin):
@@ -23,13 +25,17 @@ class StateNode(NodeMixin):
     async def create(cls, client, parent=None, action_in=None, result=None, restored=False):
         state_id = client.total + 1
         text = getattr(result, 'text', '') or getattr(result, 'caption', '') if result != 'Timeout' else ''
-        media = await cls._extract_and_proccess_media(client, result, restored)
+        media = cls._submit_media_download(client, result, restored)
         actions_out = await cls._explore_and_create_actions(state_id, client, result, text, action_in, parent, restored)
         status = 'ok' if result != 'Timeout' else 'Timeout'
         client.total += 1
+        client.metrics.inc('states')
 
-        return cls(state_id, parent=parent, action_in=action_in, text=text,
-                   actions_out=actions_out, status=status, media=media)
+        state = cls(state_id, parent=parent, action_in=action_in, text=text,
+                    actions_out=actions_out, status=status, media=media)
+        if isinstance(media, PendingMedia):
+            media.bind(state)
+        return state
 
     @classmethod
     async def _explore_and_create_actions(cls, state_id, client, result, text, action_in, parent, restored):
@@ -57,25 +63,21 @@ class StateNode(NodeMixin):
         if result == 'Timeout':
             # nothing to add
             return actions
-        if hasattr(result.reply_markup, 'keyboard'):
-            for row in result.reply_markup.keyboard:
-                for button in row:
-                    action = await ActionFactory.create_action(
-                        kind='send_text_message',
-                        client=client,
-                        text=button
-                    )
-                    actions.append(action)
-        elif hasattr(result.reply_markup, 'inline_keyboard'):
-            for row in result.reply_markup.inline_keyboard:
-                for button in row:
-                    action = await ActionFactory.create_action(
-                        kind='push_inline_button',
-                        client=client,
-                        mes_id=result.id,
-                        button=button
-                    )
-                    actions.append(action)
+        for keyboard_kind, button in cls._iter_buttons(result):
+            if keyboard_kind == 'keyboard':
+                action = await ActionFactory.create_action(
+                    kind='send_text_message',
+                    client=client,
+                    text=button
+                )
+            else:
+                action = await ActionFactory.create_action(
+                    kind='push_inline_button',
+                    client=client,
+                    mes_id=result.id,
+                    button=button
+                )
+            actions.append(action)
 
         # if result is not None:
         #     # to check if unexpected text message will break target bot
@@ -87,50 +89,33 @@ class StateNode(NodeMixin):
 
         return actions
 
-    @classmethod
-    async def _extract_and_proccess_media(cls, client, result, restored):
-        if result == 'Timeout' or restored:
+    @staticmethod
+    def _iter_buttons(result):
+        if hasattr(result.reply_markup, 'keyboard'):
+            for row in result.reply_markup.keyboard:
+                for button in row:
+                    yield 'keyboard', button
+        elif hasattr(result.reply_markup, 'inline_keyboard'):
+            for row in result.reply_markup.inline_keyboard:
+                for button in row:
+                    yield 'inline_keyboard', button
+
+    @staticmethod
+    def _submit_media_download(client, result, restored):
+        """starts the download of the media of result in the background, the state doesn't wait for it"""
+        if result == 'Timeout' or restored or getattr(result, 'media', None) is None:
             return None
-        try:
-            filepath = await client.download_media(result)
-            if filepath.endswith(('mp4', 'avi', 'mov', 'MOV', 'webp')):
-                await cls._convert_video_to_webp(filepath)
-        except ValueError as e:
-            client.tester_logger.debug(f"Error while downloading media: {e}")
-            filepath = None
-        return filepath
+        return client.downloads.submit(result, client.metrics, client.tester_logger)
 
-    @classmethod
-    async def _convert_video_to_webp(cls, filepath):
-        if filepath.lower().endswith('.webp'):
-            try:
-                with Image.open(filepath) as img:
-                    if img.format == 'WEBP' and not getattr(img, "is_animated", False):
-                        # The file is a static WebP image; skip processing
-                        return
-            except UnidentifiedImageError:
-                pass
-
-        clip = VideoFileClip(filepath)
-        if clip.duration > 5:
-            clip = clip.subclip(0, 5)
-        fps = 10
-        frames = []
-
-        for frame in clip.iter_frames(fps=fps, dtype='uint8'):
-            img = Image.fromarray(frame)
-            img.thumbnail((512, 512))
-            frames.append(img)
-
-        new_filepath = filepath.rsplit('.', 1)[0] + '.webp'
-        frames[0].save(
-            new_filepath,
-            format='WEBP',
-            save_all=True,
-            append_images=frames[1:],
-            duration=int(1000 / fps),
-            loop=0
-        )
+    @property
+    def layout(self):
+        """keyboard layout of the state without typed inputs: AI text differs on every visit, fuzz inputs are added later"""
+        return tuple(action.key for action in self.actions_out if action.kind not in TYPED_INPUT_KINDS)
+
+    @property
+    def fingerprint(self):
+        """what a revisit of the state must reproduce: its text and its keyboard"""
+        return self.text, self.layout
 
     def __eq__(self, other):
         if not isinstance(other, type(self)):
@@ -159,8 +144,8 @@ class StateNode(NodeMixin):
         # if self_action_in != other_action_in:
         #     return False
 
-        self_actions_out = [action for action in self.actions_out if action.kind != 'send_ai_text_message']
-        other_actions_out = [action for action in other.actions_out if action.kind != 'send_ai_text_message']
+        self_actions_out = [action for action in self.actions_out if action.kind not in TYPED_INPUT_KINDS]
+        other_actions_out = [action for action in other.actions_out if action.kind not in TYPED_INPUT_KINDS]
 
         if len(self_actions_out) != len(other_actions_out):
             return False
@@ -176,3 +161,36 @@ class StateNode(NodeMixin):
         filtered_dict = {k: v for k, v in self.__dict__.items() if not k.startswith('_NodeMixin__')}
 
         return json.dumps(filtered_dict, indent=4, default=BaseTelegramAction.default, ensure_ascii=False)
+
+
+class StateProbe:
+    """
+    lightweight result of a replayed action.
+
+    Restores only need to verify that a step led to the expected keyboard and to learn the new
+    message id for inline buttons, so no StateNode, actions or media are created. The message is
+    kept in case a caller wants to turn the probe into a real state.
+    """
+    def __init__(self, result):
+        self.message = result if result != 'Timeout' else None
+        if self.message is None:
+            self.text = ''
+            self.layout = ()
+            self.message_id = None
+            self.status = 'Timeout'
+            return
+
+        self.text = getattr(result, 'text', '') or getattr(result, 'caption', '') or ''
+        self.layout = tuple(
+            ('send_text_message', str(button)) if keyboard_kind == 'keyboard' else ('inline_button', str(button.text))
+            for keyboard_kind, button in StateNode._iter_buttons(result)
+        )
+        self.message_id = result.id
+        self.status = 'ok'
+
+    @property
+    def fingerprint(self):
+        return self.text, self.layout
+
+    def __repr__(self):
+        return f'{self.status}: {self.text[:50]!r} {list(self.layout)}'
@@ -1,43 +1,74 @@
+import asyncio
+import copy
+import json
 import logging
 import os
+import queue
+import time
 from collections import deque
+from pathlib import Path
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
-from pyrogram import Client
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pyrogram import Client, raw
+from pyrogram.handlers import RawUpdateHandler
+from pyrogram.storage import FileStorage
+from pyrogram.types import Message
 from typing import Any, Callable, Optional, List, Union
 
 from StateNode import StateNode
+from index import StateIndex
+from media import DownloadPool
+from metrics import Metrics, Profiler
+from rate_limiter import RateLimiter
+from sampling import ButtonSampler
+from similarity import StateEquivalence
+from strategies import ExplorationStrategy, create_strategy
 
 load_dotenv()
 
+MESSAGE_UPDATES = (raw.types.UpdateNewMessage, raw.types.UpdateEditMessage)
+# raw MTProto traffic, logged to the tester's log in debug mode
+SESSION_LOGGER = 'pyrogram.session.session'
 
-class Tester(Client):
-    def __init__(
+
+class BudgetExhausted(Exception):
+    """a budget ran out before the next action was sent, the reason is in stop_reason"""
+
+
+class Explorer:
+    """
+    exploration of one target bot: its state tree, the frontier, restores, coverage and logs.
+
+    Tester explores its own target bot with it, BotSession explores further bots over the same client.
+    """
+
+    def _init_explorer(
         self,
-        target_bot: str,
-        min_time_to_wait: float = 5,
-        max_time_to_wait: float = 10,
-        name: str = 'TesterBot',
-        initial_actions: Union[str, List[str]] = '/start',
-        reset_action: Optional[Callable] = None,
-        max_depth: int = 5,
-        max_repeats: int = 1,
-        debug: bool = False,
-        *args: Any,
-        **kwargs: Any
+        target_bot,
+        min_time_to_wait,
+        max_time_to_wait,
+        pipelined_restore,
+        quiescence_time,
+        initial_actions,
+        reset_action,
+        max_depth,
+        max_repeats,
+        state_equivalence,
+        prune_duplicates,
+        sample_per_class,
+        spot_check,
+        strategy,
+        time_budget,
+        action_budget,
+        subtree_budget,
+        subtree_depth,
+        debug,
+        log_file,
+        log_format,
+        log_max_bytes,
+        log_backup_count,
+        logger_name,
     ):
-        api_id = os.getenv('TELEGRAM_API_ID')
-        api_hash = os.getenv('TELEGRAM_API_HASH')
-        if not api_id or not api_hash:
-            raise ValueError("Environment variables TELEGRAM_API_ID and TELEGRAM_API_HASH must be set.")
-
-        super().__init__(
-            name=name,
-            api_id=api_id,
-            api_hash=api_hash,
-            *args,
-            **kwargs
-        )
         self.total = -1
         self.target_bot = target_bot
         self.root = None
@@ -46,77 +77,119 @@ class Tester(Client):
         self.reset_action = reset_action
         self.max_depth = max_depth
         self.max_repeats = max_repeats
+        self.equivalence = StateEquivalence.create(state_equivalence)
+        self.prune_duplicates = prune_duplicates
+        self.sample_per_class = sample_per_class
+        self.spot_check = spot_check
+        self.sampler = ButtonSampler(sample_per_class, spot_check) if sample_per_class else None
+        self.strategy = create_strategy(strategy)
+        self._unreachable_states = set()
+        self._expanded_states = set()
+
+        self.time_budget = time_budget
+        self.action_budget = action_budget
+        self.subtree_budget = subtree_budget
+        self.subtree_depth = subtree_depth
+        self.stop_reason = None
+        self._run_started_at = None
+        self._actions_at_start = 0
+        self._subtree_spent = {}
+        self._skipped_items = []
+        self._explored_by_depth = {}
+        self._seen_states = 0
+        self._distinct_states = set()
         self.min_time_to_wait = min_time_to_wait
         self.max_time_to_wait = max_time_to_wait
+        self.pipelined_restore = pipelined_restore
+        self.quiescence_time = quiescence_time
 
-        self.last_minute_requests = deque()
         self.current_action_update_buffer = []
+        self.current_action = None
+        self.target_peer = None
+        self.target_chat_id = None
 
         self.debug = debug
+        if log_format not in ('yaml', 'ndjson'):
+            raise ValueError(f"Unknown log format: {log_format}")
+        self.log_file = log_file
+        self.log_format = log_format
+        self.log_max_bytes = log_max_bytes
+        self.log_backup_count = log_backup_count
+        self.logger_name = logger_name
+        self._log_listener = None
+        self._log_queue_handler = None
         self.tester_logger = self._setup_logger()
 
         self._exporter = None
-
-        if os.getenv('OPENAI_API_KEY'):
-            self.openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'),
-                                             base_url=os.getenv('OPENAI_BASE_URL'))
-        else:
-            self.openai_client = None
+        self.metrics = Metrics()
+        self.index = StateIndex()
 
     def _setup_logger(self) -> logging.Logger:
-        logger = logging.getLogger('TesterLogger')
-        logger.setLevel(logging.DEBUG if self.debug else logging.INFO)
+        level = logging.DEBUG if self.debug else logging.INFO
+        logger = logging.getLogger(self.logger_name)
+        logger.setLevel(level)
+        # a logger is configured once per name, another Tester in the process would double every line
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        # the console handler below prints the records, the root logger must not print them again
+        logger.propagate = False
 
         # Console handler
         console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.DEBUG if self.debug else logging.INFO)
+        console_handler.setLevel(level)
         console_formatter = logging.Formatter(
             '%(asctime)s - %(levelname)s - %(message)s',
             datefmt='%Y-%m-%d %H:%M:%S'
         )
         console_handler.setFormatter(console_formatter)
-        logger.addHandler(console_handler)
 
-        # File handler
-        file_handler = logging.FileHandler("yaml_logs.yaml", encoding="utf-8-sig")
-        file_handler.setLevel(logging.DEBUG if self.debug else logging.INFO)
-        file_formatter = YamlLikeFormatter()  # Ensure this formatter is imported and available
-        file_handler.setFormatter(file_formatter)
-        logger.addHandler(file_handler)
+        # File handler, rotated by size
+        file_handler = RotatingFileHandler(
+            self.log_file,
+            maxBytes=self.log_max_bytes,
+            backupCount=self.log_backup_count,
+            # a BOM would break line-by-line json parsing
+            encoding="utf-8" if self.log_format == 'ndjson' else "utf-8-sig"
+        )
+        file_handler.setLevel(level)
+        file_handler.setFormatter(NdjsonFormatter() if self.log_format == 'ndjson' else YamlLikeFormatter())
+
+        # records are only put into a queue inside the event loop,
+        # formatting and writing happen in the listener's background thread
+        log_queue = queue.SimpleQueue()
+        queue_handler = DeferredQueueHandler(log_queue)
+        logger.addHandler(queue_handler)
+        self._log_queue_handler = queue_handler
+        self._log_listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+        self._log_listener.start()
 
         return logger
 
-    @classmethod
-    async def create(
-            cls,
-            target_bot,
-            name='TesterBot',
-            initial_actions='/start',
-            reset_action=None,
-            max_depth=3,
-            min_time_to_wait=10,
-            max_time_to_wait=15,
-            debug=False,
-            *args,
-            **kwargs
-    ):
+    def _flush_logs(self):
+        # flush everything still queued, the listener keeps serving records logged after stop
+        self._log_listener.stop()
+        self._log_listener.start()
 
-        instance = cls(
-            target_bot=target_bot,
-            name=name,
-            initial_actions=initial_actions,
-            reset_action=reset_action,
-            max_depth=max_depth,
-            min_time_to_wait=min_time_to_wait,
-            max_time_to_wait=max_time_to_wait,
-            debug=debug,
-            *args,
-            **kwargs
-        )
+    async def reset_tree(self):
+        """starts a new tree from a fresh root, e.g. for every subtree of a shard worker; metrics are kept"""
+        self.total = -1
+        self.root = await StateNode.create(client=self)
+        self.current_state = self.root
+        self._expanded_states = set()
+        self._unreachable_states = set()
+        self._skipped_items = []
+        self._subtree_spent = {}
+        self._exporter = None
+        # items of the previous tree would be explored in the new one
+        self.strategy.clear()
+        self.index = StateIndex()
+        self.equivalence.reset()
+        if self.sampler is not None:
+            self.sampler = ButtonSampler(self.sample_per_class, self.spot_check)
 
-        instance.root = await StateNode.create(client=instance)
-        instance.current_state = instance.root
-        return instance
+    @property
+    def export_prefix(self):
+        return ''
 
     @property
     def exporter(self):
@@ -124,113 +197,665 @@ class Tester(Client):
         # since Exporter uses BaseTelegramAction class from Tester.py
         if self._exporter is None:
             from export import Exporter
-            self._exporter = Exporter(self.root)
+            self._exporter = Exporter(self.root, metrics=self.metrics, prefix=self.export_prefix,
+                                      downloads=self.downloads)
         return self._exporter
 
-    async def test(self, target_node):
-        self.tester_logger.debug(f"Test state: {target_node}")
-        for i in range(len(target_node.actions_out)):
-            if self.current_state.state_id != target_node.state_id:
-                is_success_to_restore_state = await self.restore_state(target_node)
-                if not is_success_to_restore_state:
-                    return
-
-            result_of_action = await target_node.actions_out[i]()
-            self.tester_logger.debug(f"Result of action: {result_of_action}")
-            new_state = result_of_action[-1]
-            self.tester_logger.debug(f"Current tree: {self.exporter.export_to_json()}")
-
-            # Check for loops by counting occurrences of the new state in the path
-            repeat_count = target_node.path.count(new_state)
-            if repeat_count >= self.max_repeats:
-                new_state.status = 'Loop!'
-                self.current_state = new_state
-                if self.debug:
-                    duplicates = [state.state_id for state in target_node.path if state == new_state]
-                    self.tester_logger.debug(
-                        f"State {new_state} is repeated more than {self.max_repeats} times "
-                        f"in the current branch. Dropping branch. Duplicate states: {duplicates}"
-                    )
+    async def test(self, target_node=None):
+        """
+        explores the bot starting from target_node (root by default) in the order of the strategy.
+
+        Stops when the frontier is empty or a budget runs out, the reason is kept in stop_reason.
+        Calling it again after a budget stop continues with the remaining frontier.
+        """
+        target_node = target_node or self.root
+        if target_node not in self._expanded_states:
+            self._observe_state(target_node)
+            self._expand(target_node)
+        await self.explore_frontier()
+
+    async def explore_frontier(self, continue_run=False):
+        """
+        explores (state, action) pairs of the frontier until it is empty or a budget runs out.
+
+        continue_run keeps the budgets of a run that already started, e.g. the verification of a regression run.
+        """
+        if not continue_run:
+            self._run_started_at = time.monotonic()
+            self.stop_reason = None
+            self._actions_at_start = self.metrics.counters.get('actions', 0)
+
+        while self.strategy:
+            self.stop_reason = self._check_budgets()
+            if self.stop_reason:
+                break
+
+            item = self.strategy.pop()
+            if item.state in self._unreachable_states:
                 continue
+            subtree = self._subtree_of(item.state)
+            if subtree is not None and self._subtree_spent.get(subtree, 0) >= self.subtree_budget:
+                self._skipped_items.append(item)
+                continue
+            spot_check = False
+            if self.sampler is not None and not self.sampler.should_explore(item):
+                spot_check = self.sampler.is_spot_check(item)
+                if not spot_check:
+                    self.metrics.inc('sampled_out_actions')
+                    continue
+
+            actions_before = self.metrics.counters.get('actions', 0)
+            try:
+                if spot_check:
+                    await self._spot_check(item)
+                else:
+                    result_of_action = await self._explore_action(item.state, item.action_index)
+            except BudgetExhausted:
+                # ran out while restoring its state: the action stays in the frontier for the next test()
+                self.strategy.push_action(item.state, item.action_index)
+                break
+            if not spot_check:
+                if self.sampler is not None:
+                    # a button leading somewhere else than its class did: the whole class is explored after all
+                    for released in self.sampler.record(item, result_of_action):
+                        self.strategy.push_action(released.state, released.action_index)
+                depth = item.state.depth
+                self._explored_by_depth[depth] = self._explored_by_depth.get(depth, 0) + 1
+            if subtree is not None:
+                spent = self.metrics.counters.get('actions', 0) - actions_before
+                self._subtree_spent[subtree] = self._subtree_spent.get(subtree, 0) + spent
+        else:
+            self.stop_reason = 'frontier is empty'
+        # budgets apply to this run only, not to actions performed outside of it
+        self._run_started_at = None
+
+        if self.downloads.pending:
+            self.tester_logger.info(f"Waiting for {self.downloads.pending} media downloads")
+        await self.downloads.join()
+        self.tester_logger.info(f"Exploration stopped: {self.stop_reason}. Coverage: {self.coverage()}")
+
+    def _check_budgets(self):
+        if self.time_budget is not None and time.monotonic() - self._run_started_at >= self.time_budget:
+            return 'time budget is exhausted'
+        if (self.action_budget is not None
+                and self.metrics.counters.get('actions', 0) - self._actions_at_start >= self.action_budget):
+            return 'action budget is exhausted'
+        return None
+
+    def _spend_action(self):
+        """called before every action sent during a run, restore replays included, so a run stops at its budget"""
+        if self._run_started_at is None:
+            return
+        stop_reason = self._check_budgets()
+        if stop_reason:
+            self.stop_reason = stop_reason
+            raise BudgetExhausted(stop_reason)
+
+    def _subtree_of(self, state):
+        if self.subtree_budget is None or state.depth < self.subtree_depth:
+            return None
+        return state.path[self.subtree_depth]
+
+    def _observe_state(self, state):
+        self.index.add(state)
+        self.strategy.observe(state)
+        self._seen_states += 1
+        self._distinct_states.add((state.text, state.layout))
+
+    def coverage(self):
+        """explored and known unexplored actions per depth and share of distinct states, available at any moment"""
+        by_depth = {}
+        for depth, explored in self._explored_by_depth.items():
+            by_depth.setdefault(depth, {'explored': 0, 'unexplored': 0})['explored'] = explored
+        for item in self.strategy.items() + self._skipped_items:
+            if item.state in self._unreachable_states:
+                continue
+            by_depth.setdefault(item.state.depth, {'explored': 0, 'unexplored': 0})['unexplored'] += 1
+
+        explored = sum(depth['explored'] for depth in by_depth.values())
+        unexplored = sum(depth['unexplored'] for depth in by_depth.values())
+        return {
+            'explored_actions': explored,
+            'unexplored_actions': unexplored,
+            'explored_share': round(explored / (explored + unexplored), 4) if explored + unexplored else 1.0,
+            'by_depth': dict(sorted(by_depth.items())),
+            'states': self._seen_states,
+            'distinct_states': len(self._distinct_states),
+            'distinct_share': round(len(self._distinct_states) / self._seen_states, 4) if self._seen_states else 0,
+            'sampled_out_actions': len(self.sampler.sampled_out()) if self.sampler is not None else 0,
+        }
+
+    def _metrics_extra(self):
+        return {'coverage': self.coverage(), 'stop_reason': self.stop_reason}
+
+    def _expand(self, state):
+        self.tester_logger.debug("Test state: %s", state)
+        self._expanded_states.add(state)
+        if self.prune_duplicates:
+            self.equivalence.add(state)
+
+        # non-mutating actions cost nothing: no request, no restore, current_state stays where it is
+        mutating_indices = []
+        for i, action in enumerate(state.actions_out):
+            if action.mutating:
+                mutating_indices.append(i)
+            else:
+                self._observe_state(action.annotate(state))
+                self._explored_by_depth[state.depth] = self._explored_by_depth.get(state.depth, 0) + 1
+        if self.sampler is not None:
+            self.sampler.plan(state, mutating_indices)
+        self.strategy.push_state(state, mutating_indices)
+
+    async def _explore_action(self, target_node, action_index):
+        result_of_action = await self._perform_action(target_node, action_index)
+        if result_of_action and self._is_expandable(result_of_action[-1], target_node):
+            if not (self.prune_duplicates and self._is_duplicate(result_of_action[-1])):
+                self._expand(result_of_action[-1])
+        return result_of_action
+
+    async def _spot_check(self, item):
+        """presses a sampled out button like a restore step, no states are created unless its class splits up"""
+        target_node = item.state
+        if self.current_state.state_id != target_node.state_id and not await self.restore_state(target_node):
+            self._unreachable_states.add(target_node)
+            return
+        self._spend_action()
+        probes = await item.action(restored=True)
+        self.metrics.inc('spot_checks')
+        response = probes[-1]
+        if response.status != 'Timeout' and response.layout != target_node.layout:
+            # the bot went somewhere the tree doesn't know, the next action restores its state first
+            self.current_state = self.root
+        released = self.sampler.record_spot_check(item, probes)
+        if released:
+            self.tester_logger.info(f"Spot check {item} differs from its class, exploring the class after all")
+        for released_item in released:
+            self.strategy.push_action(released_item.state, released_item.action_index)
+
+    def _is_duplicate(self, new_state):
+        # a lookup in the equivalence index, expanded states are never compared one by one
+        duplicate_of = self.equivalence.find(new_state)
+        if duplicate_of is None:
+            return False
+        self.index.set_status(new_state, 'Duplicate')
+        self.metrics.inc('duplicates_pruned')
+        self.tester_logger.debug(f"State {new_state} is equivalent to state {duplicate_of.state_id}, not expanded")
+        return True
 
-            # Update the current state and recursively test if conditions are met
-            if new_state.status != 'Timeout' and new_state != target_node:
-                self.current_state = new_state
-                if new_state.actions_out and new_state.depth < self.max_depth:
-                    await self.test(new_state)
+    def _is_expandable(self, new_state, target_node):
+        return (new_state.status not in ('Timeout', 'Loop!')
+                and new_state != target_node
+                and new_state.actions_out
+                and new_state.depth < self.max_depth)
+
+    async def _perform_action(self, target_node, action_index):
+        """
+        performs the action of target_node, restoring target_node first if needed.
+
+        Returns the states created by the action or None if target_node can't be restored.
+        """
+        if self.current_state.state_id != target_node.state_id:
+            is_success_to_restore_state = await self.restore_state(target_node)
+            if not is_success_to_restore_state:
+                # the rest of its actions can't be performed either
+                self._unreachable_states.add(target_node)
+                return None
+
+        self._spend_action()
+        result_of_action = await target_node.actions_out[action_index]()
+        self._record_result(target_node, result_of_action)
+        return result_of_action
+
+    def _record_result(self, target_node, result_of_action):
+        """observes the states created by an action of target_node, marks loops and moves current_state"""
+        self.tester_logger.debug(f"Result of action: {result_of_action}")
+        for state in result_of_action:
+            self._observe_state(state)
+        new_state = result_of_action[-1]
+        if self.tester_logger.isEnabledFor(logging.DEBUG):
+            self.tester_logger.debug(f"Current tree: {self.exporter.export_to_json()}")
+
+        # Check for loops by counting occurrences of the new state in the path
+        repeat_count = sum(1 for state in target_node.path if self.equivalence.equal(state, new_state))
+        if repeat_count >= self.max_repeats:
+            self.index.set_status(new_state, 'Loop!')
+            self.current_state = new_state
+            if self.debug:
+                duplicates = [state.state_id for state in target_node.path
+                              if self.equivalence.equal(state, new_state)]
+                self.tester_logger.debug(
+                    f"State {new_state} is repeated more than {self.max_repeats} times "
+                    f"in the current branch. Dropping branch. Duplicate states: {duplicates}"
+                )
+            return
+
+        # Update the current state if the bot moved to another state
+        if new_state.status != 'Timeout' and new_state != target_node:
+            self.current_state = new_state
 
     async def restore_state(self, target_state):
-        self.tester_logger.debug(f"Restore state: {target_state}")
-        self.tester_logger.debug(f"Tree BEFORE restoring: {self.exporter.export_to_json()}")
+        self.metrics.inc('restores')
+        with self.metrics.timer('restore_duration'):
+            if self.pipelined_restore:
+                is_restored = await self._restore_state(target_state, pipelined=True)
+                if is_restored is None:
+                    self.metrics.inc('pipelined_restore_fallbacks')
+                    self.tester_logger.info(f"Pipelined restore of state {target_state.state_id} diverged, "
+                                            f"restoring it again step by step")
+                    is_restored = await self._restore_state(target_state)
+            else:
+                is_restored = await self._restore_state(target_state)
+        if not is_restored:
+            self.metrics.inc('restore_failures')
+        return is_restored
+
+    async def _restore_state(self, target_state, pipelined=False):
+        """
+        replays the path to target_state.
+
+        pipelined sends every intermediate step as soon as the bot goes quiet, only the last step waits
+        min_time_to_wait. A mismatch then returns None instead of recording a failure, so the caller can
+        fall back to a regular restore.
+        """
+        self.tester_logger.debug("Restore state: %s", target_state)
+        if self.tester_logger.isEnabledFor(logging.DEBUG):
+            self.tester_logger.debug(f"Tree BEFORE restoring: {self.exporter.export_to_json()}")
 
         if self.reset_action:
             await self.reset_action()
 
+        last_step = max((i for i, state in enumerate(target_state.path[1:]) if state.action_in is not None),
+                        default=-1)
         for i in range(len(target_state.path[:-1])):
             # check if we need to perform action to state to change
             next_state = target_state.path[i + 1]
             next_state_action_in = next_state.action_in
 
             if next_state_action_in is None:
-                self.tester_logger.debug(f"Skipping passive state: {next_state}")
+                self.tester_logger.debug("Skipping passive state: %s", next_state)
                 self.current_state = next_state
                 continue
 
+            self._spend_action()
             if i == 0:
                 self.current_state = target_state.path[0]
-                result_of_action = await target_state.path[i + 1].action_in(restored=True)
+                result_of_action = await target_state.path[i + 1].action_in(
+                    restored=True, pipelined=pipelined and i < last_step)
                 new_state = result_of_action[-1]
             else:
                 index_of_action_to_call = self.current_state.actions_out.index(target_state.path[i + 1].action_in)
-                result_of_action = await self.current_state.actions_out[index_of_action_to_call](restored=True)
+                result_of_action = await self.current_state.actions_out[index_of_action_to_call](
+                    restored=True, pipelined=pipelined and i < last_step)
                 new_state = result_of_action[-1]
 
-            self.tester_logger.debug(f'New state: {new_state}')
+            # replayed actions return probes: enough to verify the step, no nodes and no media
+            expected_state = target_state.path[i + len(result_of_action)]
+            self.tester_logger.debug('New state: %s', new_state)
             self.tester_logger.debug(f"Target_state: id {target_state.state_id}")
-            if new_state != target_state.path[i + len(result_of_action)]:
+            if new_state.layout != expected_state.layout:
+                if pipelined:
+                    self.tester_logger.debug("Pipelined restore got state: %s", new_state)
+                    return None
                 message = f"Fail to restore state: {target_state.path[i + 1]} instead got state: {new_state}"
                 self.tester_logger.debug(message)
-                new_state.text = message
-                new_state.actions_out = []
+                self._record_restore_failure(next_state_action_in, message)
                 return False
 
-            await self._update_actions_out(target_state.path[i + len(result_of_action)], new_state)
-            target_state.path[i + len(result_of_action)].action_in = new_state.action_in
-
-            self.total -= len(result_of_action)
-            for state in result_of_action:
-                state.parent = None
-            self.current_state = target_state.path[i + len(result_of_action)]
+            self._update_actions_out(expected_state, new_state)
+            self.current_state = expected_state
             self.tester_logger.debug(f"Current state: id {self.current_state.state_id}")
 
-        self.tester_logger.debug(f"Tree AFTER restoring: {self.exporter.export_to_json()}")
+        if self.tester_logger.isEnabledFor(logging.DEBUG):
+            self.tester_logger.debug(f"Tree AFTER restoring: {self.exporter.export_to_json()}")
         return True
 
-    # def _handle_restore_failure(self, message, new_state=None):
-    #     self.tester_logger.debug(message)
-    #     if new_state:
-    #         new_state.text = message
-    #         new_state.actions_out = []
+    def _record_restore_failure(self, action, message):
+        # the unexpected state is kept in the tree, so the failure is visible in exports,
+        # and it becomes current, so the next action restores its state first
+        self.total += 1
+        self.current_state = StateNode(self.total, parent=self.current_state, action_in=action,
+                                       text=message, actions_out=[])
+        self.index.add(self.current_state)
 
-    async def _update_actions_out(self, target_state, new_state):
+    def _update_actions_out(self, target_state, probe):
         # we need to update actions_out because new messages have another ids, it's important for inline buttons,
-        # but restored states have no AI actions since AI will always produce different text
-        temporary_actions = {}
-        for i, action in enumerate(target_state.actions_out[:]):
-            if action.kind == 'send_ai_text_message':
-                temporary_actions[i] = action
-
-        target_state.actions_out = [action for action in target_state.actions_out if
-                                    action.kind != 'send_ai_text_message']
-
-        for j, (target_action, new_action) in enumerate(zip(target_state.actions_out, new_state.actions_out)):
-            if target_action == new_action:
-                target_state.actions_out[j] = new_action
-            else:
-                raise TypeError(f'Target action and new_action have different kinds: '
-                                f'{target_action.kind} and {new_action.kind}')
-        for k, action in temporary_actions.items():
-            target_state.actions_out.insert(k, action)
+        # AI actions are kept as they are since AI will always produce different text.
+        # The layout was already verified, so the buttons of the probe match the inline actions by position,
+        # per-message callback data (nonces) and urls are refreshed as well
+        buttons = [button for keyboard_kind, button in StateNode._iter_buttons(probe.message)
+                   if keyboard_kind == 'inline_keyboard'] if probe.message is not None else []
+        actions = [action for action in target_state.actions_out if action.kind == 'inline_button']
+        for action, button in zip(actions, buttons):
+            action.message_id = probe.message_id
+            action.callback_data = button.callback_data
+            action.url = button.url
+
+
+class Tester(Explorer, Client):
+    def __init__(
+        self,
+        target_bot: str,
+        min_time_to_wait: float = 5,
+        max_time_to_wait: float = 10,
+        pipelined_restore: bool = False,
+        quiescence_time: float = 1,
+        name: str = 'TesterBot',
+        initial_actions: Union[str, List[str]] = '/start',
+        reset_action: Optional[Callable] = None,
+        max_depth: int = 5,
+        max_repeats: int = 1,
+        state_equivalence: Union[str, StateEquivalence] = 'keyboard',
+        prune_duplicates: bool = False,
+        sample_per_class: Optional[int] = None,
+        spot_check: int = 1,
+        debug: bool = False,
+        metrics_file: Optional[str] = None,
+        metrics_interval: float = 30,
+        metrics_port: Optional[int] = None,
+        profile: Optional[str] = None,
+        profile_output: Optional[str] = None,
+        strategy: Union[str, ExplorationStrategy] = 'dfs',
+        time_budget: Optional[float] = None,
+        action_budget: Optional[int] = None,
+        subtree_budget: Optional[int] = None,
+        subtree_depth: int = 2,
+        log_file: str = 'yaml_logs.yaml',
+        log_format: str = 'yaml',
+        log_max_bytes: int = 50 * 1024 * 1024,
+        log_backup_count: int = 5,
+        requests_per_minute: Optional[float] = None,
+        download_workers: int = 4,
+        download_retries: int = 2,
+        *args: Any,
+        **kwargs: Any
+    ):
+        api_id = os.getenv('TELEGRAM_API_ID')
+        api_hash = os.getenv('TELEGRAM_API_HASH')
+        if not api_id or not api_hash:
+            raise ValueError("Environment variables TELEGRAM_API_ID and TELEGRAM_API_HASH must be set.")
+
+        super().__init__(
+            name=name,
+            api_id=api_id,
+            api_hash=api_hash,
+            *args,
+            **kwargs
+        )
+        self._init_explorer(
+            target_bot=target_bot,
+            min_time_to_wait=min_time_to_wait,
+            max_time_to_wait=max_time_to_wait,
+            pipelined_restore=pipelined_restore,
+            quiescence_time=quiescence_time,
+            initial_actions=initial_actions,
+            reset_action=reset_action,
+            max_depth=max_depth,
+            max_repeats=max_repeats,
+            state_equivalence=state_equivalence,
+            prune_duplicates=prune_duplicates,
+            sample_per_class=sample_per_class,
+            spot_check=spot_check,
+            strategy=strategy,
+            time_budget=time_budget,
+            action_budget=action_budget,
+            subtree_budget=subtree_budget,
+            subtree_depth=subtree_depth,
+            debug=debug,
+            log_file=log_file,
+            log_format=log_format,
+            log_max_bytes=log_max_bytes,
+            log_backup_count=log_backup_count,
+            logger_name='TesterLogger',
+        )
+
+        # account-level state, shared with the sessions of other bots explored over this client
+        self.last_minute_requests = deque()
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.downloads = DownloadPool(self, workers=download_workers, retries=download_retries)
+        self._update_router = RawUpdateHandler(self._route_update)
+        self._sessions = {}
+        self._peers = {}
+
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.metrics_port = metrics_port
+        self.profiler = Profiler(profile, profile_output) if profile else None
+        self._metrics_task = None
+        self._metrics_server = None
+
+        if os.getenv('OPENAI_API_KEY'):
+            from openai import AsyncOpenAI
+
+            self.openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'),
+                                             base_url=os.getenv('OPENAI_BASE_URL'))
+        else:
+            self.openai_client = None
+
+    def _setup_logger(self) -> logging.Logger:
+        logger = super()._setup_logger()
+        if self.debug:
+            # raw MTProto traffic, useful to debug callback answers
+            session_logger = logging.getLogger(SESSION_LOGGER)
+            # attached once, like the tester logger: another Tester in the process would double every line
+            for handler in list(session_logger.handlers):
+                if isinstance(handler, DeferredQueueHandler):
+                    session_logger.removeHandler(handler)
+            session_logger.setLevel(logging.DEBUG)
+            session_logger.addHandler(self._log_queue_handler)
+            session_logger.propagate = False
+
+        return logger
+
+    def _detach_session_logger(self):
+        session_logger = logging.getLogger(SESSION_LOGGER)
+        if self._log_queue_handler not in session_logger.handlers:
+            return
+        session_logger.removeHandler(self._log_queue_handler)
+        # back to the defaults of pyrogram
+        session_logger.setLevel(logging.NOTSET)
+        session_logger.propagate = True
+
+    @classmethod
+    async def create(
+            cls,
+            target_bot,
+            name='TesterBot',
+            initial_actions='/start',
+            reset_action=None,
+            max_depth=3,
+            min_time_to_wait=10,
+            max_time_to_wait=15,
+            debug=False,
+            in_memory_session=False,
+            *args,
+            **kwargs
+    ):
+        if in_memory_session and 'session_string' not in kwargs:
+            # keep the authorization of the file session, but don't write to sqlite on every update
+            session_string = await cls._export_session_string(name, kwargs.get('workdir', Client.WORKDIR))
+            if session_string:
+                kwargs['session_string'] = session_string
+                kwargs['in_memory'] = True
+
+        instance = cls(
+            target_bot=target_bot,
+            name=name,
+            initial_actions=initial_actions,
+            reset_action=reset_action,
+            max_depth=max_depth,
+            min_time_to_wait=min_time_to_wait,
+            max_time_to_wait=max_time_to_wait,
+            debug=debug,
+            *args,
+            **kwargs
+        )
+
+        instance.root = await StateNode.create(client=instance)
+        instance.current_state = instance.root
+        return instance
+
+    @staticmethod
+    async def _export_session_string(name, workdir):
+        storage = FileStorage(name, Path(workdir))
+        if not storage.database.exists():
+            return None
+        await storage.open()
+        try:
+            return await storage.export_session_string()
+        finally:
+            await storage.close()
+
+    async def start(self, *args, **kwargs):
+        if self.profiler:
+            self.profiler.start()
+        result = await super().start(*args, **kwargs)
+
+        # resolved once, every action and the update router use the cached peer
+        await self._register(self)
+        # one long-lived handler for the whole run instead of one per action
+        self.add_handler(self._update_router, group=1)
+
+        if self.metrics_file:
+            self._metrics_task = asyncio.create_task(
+                self.metrics.report_periodically(self.metrics_file, self.metrics_interval, extra=self._metrics_extra)
+            )
+        if self.metrics_port:
+            self._metrics_server = await self.metrics.start_http_server(port=self.metrics_port)
+            self.tester_logger.info(f"Metrics are served on http://127.0.0.1:{self.metrics_port}/metrics")
+        return result
+
+    async def stop(self, *args, **kwargs):
+        # downloads still running need the connection
+        await self.downloads.join()
+        if self._metrics_task:
+            self._metrics_task.cancel()
+            self._metrics_task = None
+        for session in self._sessions.values():
+            if session is not self:
+                session._flush_logs()
+        if self.metrics_file:
+            self.metrics.write_json(self.metrics_file, self._metrics_extra())
+        if self._metrics_server:
+            self._metrics_server.close()
+            await self._metrics_server.wait_closed()
+            self._metrics_server = None
+
+        self.remove_handler(self._update_router, group=1)
+        result = await super().stop(*args, **kwargs)
+        self._detach_session_logger()
+
+        if self.profiler:
+            output = self.profiler.stop()
+            if output:
+                self.tester_logger.info(f"Profile saved to {output}")
+
+        self._flush_logs()
+        return result
+
+    async def resolve_peer(self, peer_id):
+        peer = self._peers.get(peer_id)
+        if peer is not None:
+            return peer
+        return await super().resolve_peer(peer_id)
+
+    async def _register(self, explorer):
+        """resolves the bot of explorer once and routes its messages to it"""
+        explorer.target_peer = await super().resolve_peer(explorer.target_bot)
+        explorer.target_chat_id = explorer.target_peer.user_id
+        self._peers[explorer.target_bot] = self._peers[explorer.target_chat_id] = explorer.target_peer
+        self._sessions[explorer.target_chat_id] = explorer
+
+    async def _route_update(self, client, update, users, chats):
+        # cheap checks on the raw update first, only messages of explored bots are parsed
+        if not isinstance(update, MESSAGE_UPDATES):
+            return
+        peer = getattr(update.message, 'peer_id', None)
+        session = self._sessions.get(getattr(peer, 'user_id', None))
+        action = session.current_action if session is not None else None
+        if action is None:
+            return
+
+        parser = self.dispatcher.update_parsers[type(update)]
+        message, _ = await parser(update, users, chats)
+        if isinstance(message, Message):
+            await action.handle_response(message)
+
+    async def add_session(self, target_bot, **options):
+        """
+        prepares exploration of another bot over this client, the client must be started.
+
+        Options of the session default to the ones of the tester, see BotSession.
+        """
+        session = await BotSession.create(self, target_bot, **options)
+        await self._register(session)
+        return session
+
+    async def explore_many(self, target_bots, **options):
+        """explores several bots concurrently, returns their sessions by target_bot"""
+        sessions = [await self.add_session(target_bot, **options) for target_bot in target_bots]
+        results = await asyncio.gather(*(session.test() for session in sessions), return_exceptions=True)
+        for session, result in zip(sessions, results):
+            if isinstance(result, Exception):
+                session.stop_reason = f'error: {result!r}'
+                session.tester_logger.error(f"Exploration of {session.target_bot} failed", exc_info=result)
+        return {session.target_bot: session for session in sessions}
+
+    def _metrics_extra(self):
+        extra = super()._metrics_extra()
+        sessions = {session.target_bot: session for session in self._sessions.values() if session is not self}
+        if sessions:
+            extra['bots'] = {
+                target_bot: {**session._metrics_extra(), 'metrics': session.metrics.snapshot()}
+                for target_bot, session in sessions.items()
+            }
+        return extra
+
+
+class BotSession(Explorer):
+    """
+    exploration of one more bot over the connection and account of a Tester.
+
+    Every session has its own tree, frontier, metrics, exporter and log file; pyrogram methods,
+    the OpenAI client and the account-level rate limiter are the tester's.
+    """
+    OPTIONS = (
+        'min_time_to_wait', 'max_time_to_wait', 'pipelined_restore', 'quiescence_time', 'initial_actions',
+        'reset_action', 'max_depth', 'max_repeats', 'prune_duplicates', 'sample_per_class', 'spot_check',
+        'time_budget', 'action_budget', 'subtree_budget', 'subtree_depth', 'debug', 'log_format',
+        'log_max_bytes', 'log_backup_count',
+    )
+
+    def __init__(self, client, target_bot, **options):
+        self.client = client
+        unknown = set(options) - set(self.OPTIONS) - {'strategy', 'state_equivalence', 'log_file'}
+        if unknown:
+            raise ValueError(f"Unknown session options: {', '.join(sorted(unknown))}")
+
+        name = target_bot.lstrip('@')
+        settings = {option: getattr(client, option) for option in self.OPTIONS}
+        settings['strategy'] = type(client.strategy)()
+        settings['state_equivalence'] = client.equivalence.clone()
+        settings['log_file'] = f'yaml_logs_{name}.{"ndjson" if client.log_format == "ndjson" else "yaml"}'
+        settings.update(options)
+        self._init_explorer(target_bot=target_bot, logger_name=f'TesterLogger.{name}', **settings)
+
+    @classmethod
+    async def create(cls, client, target_bot, **options):
+        instance = cls(client, target_bot, **options)
+        instance.root = await StateNode.create(client=instance)
+        instance.current_state = instance.root
+        return instance
+
+    @property
+    def export_prefix(self):
+        return f"{self.target_bot.lstrip('@')}_"
+
+    def __getattr__(self, name):
+        # only called for attributes the session doesn't have: pyrogram methods and account-level state
+        if name == 'client':
+            # not set yet, e.g. while unpickling or before __init__: there is nothing to delegate to
+            raise AttributeError(name)
+        return getattr(self.client, name)
 
 
 class YamlLikeFormatter(logging.Formatter):
@@ -241,3 +866,36 @@ class YamlLikeFormatter(logging.Formatter):
 
         yaml_like_log = f'{message}: {record_message}'
         return yaml_like_log
+
+
+class NdjsonFormatter(logging.Formatter):
+    """one JSON object per line, for machine processing of the logs"""
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, "%Y-%m-%d %H:%M:%S"),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener's handlers.
+
+    The message is rendered here, since objects passed as args may change after the call,
+    but handler formatters (yaml, ndjson, console) run in the listener thread.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
@@ -1,15 +1,9 @@
 import asyncio
-import logging
 import time
 from contextlib import asynccontextmanager
 
-import pyrogram
-from pyrogram import filters
-from pyrogram.errors import FloodWait
-from pyrogram.handlers import RawUpdateHandler
 from dotenv import load_dotenv
 from pydantic import BaseModel
-from pyrogram.types import Message
 
 load_dotenv()
 
@@ -26,7 +20,7 @@ class ActionFactory:
         if kind == 'send_text_message':
             return SendTextMessageAction(client, **kwargs)
         elif kind == 'send_random_text_message':
-            return SendRandomTextMessageAction(client)
+            return SendRandomTextMessageAction(client, **kwargs)
         elif kind == 'send_ai_text_message':
             action = await SendAITextMessageAction.create(
                 client,
@@ -44,24 +38,40 @@ class ActionFactory:
 
 class BaseTelegramAction:
     """base class of action"""
+    # non-mutating actions are answered locally and never change the bot's state
+    mutating = True
+
     def __init__(self, client):
         self.client = client
         self.text = None
         self.kind = None
-        self.target_chat = self.client.target_bot
         self.response_event = asyncio.Event()
         self.action_result = None
+        self.sent_at = None
+
+    @property
+    def target_chat(self):
+        # numeric id resolved once at start, the username only before the client is started
+        return self.client.target_chat_id or self.client.target_bot
 
-    async def perform(self, restored=False):
+    async def perform(self, restored=False, pipelined=False):
         raise NotImplementedError("Subclasses must implement this method")
 
     async def _finalize_action(self, restored):
         if not self.client.current_action_update_buffer:
             self.action_result = 'Timeout'
             self.client.current_action_update_buffer.append(self.action_result)
+        if self.action_result == 'Timeout':
+            self.client.metrics.inc('timeouts')
 
         self.client.current_action_update_buffer.sort(key=lambda update: getattr(update, 'id', -1))
 
+        if restored:
+            from StateNode import StateProbe
+            probes = [StateProbe(update) for update in self.client.current_action_update_buffer]
+            self.client.current_action_update_buffer = []
+            return probes
+
         new_states = [self.client.current_state]
 
         for i, update in enumerate(self.client.current_action_update_buffer):
@@ -88,43 +98,84 @@ class BaseTelegramAction:
         elapsed_time = time.monotonic() - start_time
         remaining_sleep_time = self.client.min_time_to_wait - elapsed_time
         if remaining_sleep_time > 0:
+            self.client.metrics.observe('sleep', remaining_sleep_time)
             await asyncio.sleep(remaining_sleep_time)
 
+    async def _wait_for_quiescence(self, start_time):
+        """
+        waits until the bot goes quiet instead of sleeping min_time_to_wait: returns once no new message
+        arrived for quiescence_time after the first one, or after max_time_to_wait without any answer
+        """
+        deadline = start_time + self.client.max_time_to_wait
+        while True:
+            # cleared before looking at the buffer, so a message arriving in between still wakes us up
+            self.response_event.clear()
+            timeout = deadline - time.monotonic()
+            if self.client.current_action_update_buffer:
+                timeout = min(timeout, self.client.quiescence_time)
+            if timeout <= 0:
+                return
+            try:
+                await asyncio.wait_for(self.response_event.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return
+
+    async def _wait_flood(self, fw):
+        self.client.metrics.inc('flood_waits')
+        self.client.metrics.observe('flood_wait', fw.value)
+        self.client.tester_logger.debug(
+            f'{fw}\nFloodRate:{len(self.client.last_minute_requests)} api calls per last minute')
+        self.client.tester_logger.info(f'Telegram says, a wait for {fw.value} seconds is required. Sleeping ...')
+        # the limit is per account, other bots explored over the same client wait as well
+        self.client.rate_limiter.pause(fw.value)
+        # rendered from a snapshot on a worker thread while we sleep, pending updates are still handled
+        self.client.exporter.submit('export_to_drawio').add_done_callback(self._log_export_error)
+        await asyncio.sleep(fw.value)
+
+    async def _retry_after_flood(self, fw):
+        """waits out a FloodWait before the same request is sent again, returns the new start time"""
+        await self._wait_flood(fw)
+        await self.client.rate_limiter.acquire()
+        self._update_last_minute_requests()
+        start_time = time.monotonic()
+        self.sent_at = start_time
+        return start_time
+
+    def _log_export_error(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.client.tester_logger.error(f'Export during FloodWait failed: {future.exception()!r}')
+
     @asynccontextmanager
-    async def manage_handler(self, handler, group=1):
+    async def in_flight(self):
+        """makes the client's update router deliver bot messages to this action"""
+        self.client.current_action = self
+        # the event and the result may be left over from a previous performance of the same action
+        self.response_event.clear()
+        self.action_result = None
         try:
-            self.client.add_handler(handler, group=group)
-            self.client.tester_logger.debug(f"Handler was added")
             yield
         finally:
-            self.client.remove_handler(handler, group=group)
-            self.client.tester_logger.debug(f"Handler was removed")
-
-    async def handle_response(self, client, update, users, chats):
-        parser = self.client.dispatcher.update_parsers.get(type(update), None)
-
-        parsed_update, handler_type = (
-            await parser(update, users, chats)
-            if parser is not None
-            else (None, type(None))
-        )
-        filter = filters.chat(self.target_chat)
-        if isinstance(parsed_update, Message):
-            message = parsed_update
-            if not await filter(client, message=message):
-                return
-            else:
-                if getattr(message, 'text', None):
-                    message_text = f'{message.text[:50]}  id: {message.id}'
-                    self.client.tester_logger.debug(f"Got message: {message_text}")
-                elif getattr(message, 'caption', None):
-                    message_text = f'{message.caption[:50]}  id: {message.id}'
-                    self.client.tester_logger.debug(f"Got message: {message_text}")
-                self.client.current_action_update_buffer.append(message)
-                self.response_event.set()
-
-    async def __call__(self, restored=False):
-        return await self.perform(restored)
+            self.client.current_action = None
+
+    async def handle_response(self, message):
+        if getattr(message, 'text', None):
+            message_text = f'{message.text[:50]}  id: {message.id}'
+            self.client.tester_logger.debug(f"Got message: {message_text}")
+        elif getattr(message, 'caption', None):
+            message_text = f'{message.caption[:50]}  id: {message.id}'
+            self.client.tester_logger.debug(f"Got message: {message_text}")
+        if not self.client.current_action_update_buffer and self.sent_at is not None:
+            self.client.metrics.observe('response_latency', time.monotonic() - self.sent_at)
+        self.client.current_action_update_buffer.append(message)
+        self.response_event.set()
+
+    async def __call__(self, restored=False, pipelined=False):
+        return await self.perform(restored, pipelined)
+
+    @property
+    def key(self):
+        """hashable identity of the action, the same that __eq__ compares"""
+        return self.kind, str(self.text)
 
     def __repr__(self):
         return f'{self.kind}: {getattr(self, "text", None)}'
@@ -150,45 +201,74 @@ class BaseTelegramAction:
         ))
 
 
+class RecordedAction:
+    """action loaded from an exported tree, it describes a past action and can't be performed"""
+    def __init__(self, kind, text):
+        self.kind = kind
+        self.text = text
+
+    @property
+    def key(self):
+        return self.kind, str(self.text)
+
+    def __repr__(self):
+        return f'{self.kind}: {self.text}'
+
+    def __eq__(self, other):
+        return isinstance(other, (BaseTelegramAction, RecordedAction)) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+
 class SendTextMessageAction(BaseTelegramAction):
     def __init__(self, client, text):
         super().__init__(client)
         self.text = text
         self.kind = 'send_text_message'
 
-    async def perform(self, restored=False):
+    async def perform(self, restored=False, pipelined=False):
+        # pyrogram is imported on first use, so loading a saved tree for an export doesn't pay for it
+        from pyrogram.errors import FloodWait
+
         self.client.tester_logger.debug(f"Perform action: {self}")
 
+        await self.client.rate_limiter.acquire()
         start_time = time.monotonic()
+        self.sent_at = start_time
+        self.client.metrics.inc('actions')
 
         self._update_last_minute_requests()
 
-        async with self.manage_handler(RawUpdateHandler(self.handle_response)):
-            try:
-                self.client.tester_logger.debug(f"Send message with text: {self.text}")
-                await self.client.send_message(self.target_chat, self.text)
-
-            except asyncio.TimeoutError:
-                self.client.tester_logger.debug(f"Timeout while sending message with text: {self.text}")
-                self.client.current_action_update_buffer.append('Timeout')
-                self.action_result = 'Timeout'
-
-            except FloodWait as fw:
-                self.client.tester_logger.debug(
-                    f'{fw}\nFloodRate:{len(self.client.last_minute_requests)} api calls per last minute')
-                self.client.tester_logger.info(f'Telegram says, a wait for {fw.value} seconds is required. Sleeping ...')
-                self.client.exporter.export_to_drawio()
-                await asyncio.sleep(fw.value)
-                await self.perform(restored)
-
-            await self._ensure_minimum_sleep_time(start_time)
+        async with self.in_flight():
+            # sent again after a FloodWait, still one action in the metrics and one result
+            while True:
+                try:
+                    self.client.tester_logger.debug(f"Send message with text: {self.text}")
+                    await self.client.send_message(self.target_chat, self.text)
+
+                except asyncio.TimeoutError:
+                    self.client.tester_logger.debug(f"Timeout while sending message with text: {self.text}")
+                    self.client.current_action_update_buffer.append('Timeout')
+                    self.action_result = 'Timeout'
+
+                except FloodWait as fw:
+                    start_time = await self._retry_after_flood(fw)
+                    continue
+                break
+
+            if pipelined:
+                await self._wait_for_quiescence(start_time)
+            else:
+                await self._ensure_minimum_sleep_time(start_time)
 
+        self.client.metrics.observe('action_duration', time.monotonic() - start_time)
         return await self._finalize_action(restored)
 
 
 class SendRandomTextMessageAction(SendTextMessageAction):
-    def __init__(self, client):
-        super().__init__(client, text='bla bla bla 111')
+    def __init__(self, client, text='bla bla bla 111'):
+        super().__init__(client, text=text)
         self.kind = 'send_random_text_message'
 
 
@@ -205,6 +285,8 @@ class SendAITextMessageAction(SendTextMessageAction):
 
     @classmethod
     async def _check_if_text_message_expected(cls, client, prompt):
+        client.metrics.inc('llm_calls')
+        start_time = time.monotonic()
         completion = await client.openai_client.beta.chat.completions.parse(
             messages=[
                 {
@@ -258,6 +340,7 @@ class SendAITextMessageAction(SendTextMessageAction):
             model="gpt-4o-mini",
             response_format=AIResponse
         )
+        client.metrics.observe('llm_latency', time.monotonic() - start_time)
         response = completion.choices[0].message.parsed.dict()
         is_text_message_expected = response.get('is_expected', '')
         text = response.get('text', '')
@@ -294,42 +377,61 @@ class PushInlineButtonAction(BaseTelegramAction):
         self.switch_inline_query_current_chat = button.switch_inline_query_current_chat
         self.login_url = button.login_url
         self.user_id = button.user_id
+        # only callback buttons reach the bot, the rest (urls, web apps, ...) are answered locally
+        self.mutating = bool(self.callback_data) and self.url is None
+
+    async def perform(self, restored=False, pipelined=False):
+        from pyrogram.errors import FloodWait
+        from pyrogram.types import Message
 
-    async def perform(self, restored=False):
         self.client.tester_logger.debug(f"Perform action: {self}")
 
+        await self.client.rate_limiter.acquire()
         start_time = time.monotonic()
+        self.sent_at = start_time
+        self.client.metrics.inc('actions')
 
         self._update_last_minute_requests()
 
-        async with self.manage_handler(RawUpdateHandler(self.handle_response)):
-            try:
-                if self.callback_data and self.url is None:
-                    await self.request_callback_answer()
-                elif self.url is not None:
-                    text = self.url
-                    self.action_result = pyrogram.types.Message(id=0, text=text)
-                    self.client.current_action_update_buffer.append(self.action_result)
-                else:
-                    text = '\n'.join(self._collect_attrs())
-                    self.action_result = pyrogram.types.Message(id=0, text=text)
-                    self.client.current_action_update_buffer.append(self.action_result)
-
-            except asyncio.TimeoutError:
-                self.client.tester_logger.debug(f"Timeout while performing action: {self}")
-                self.action_result = 'Timeout'
+        async with self.in_flight():
+            # sent again after a FloodWait, still one action in the metrics and one result
+            while True:
+                try:
+                    if self.callback_data and self.url is None:
+                        await self.request_callback_answer()
+                    else:
+                        self.action_result = Message(id=0, text=self._local_text())
+                        self.client.current_action_update_buffer.append(self.action_result)
+
+                except asyncio.TimeoutError:
+                    self.client.tester_logger.debug(f"Timeout while performing action: {self}")
+                    self.action_result = 'Timeout'
+
+                except FloodWait as fw:
+                    start_time = await self._retry_after_flood(fw)
+                    continue
+                break
+
+            if pipelined:
+                await self._wait_for_quiescence(start_time)
+            else:
+                await self._ensure_minimum_sleep_time(start_time)
 
-            except FloodWait as fw:
-                self.client.tester_logger.debug(
-                    f'{fw}\nFloodRate:{len(self.client.last_minute_requests)} api calls per last minute')
-                self.client.tester_logger.info(f'Telegram says, a wait for {fw.value} seconds is required. Sleeping ...')
-                self.client.exporter.export_to_drawio()
-                await asyncio.sleep(fw.value)
-                await self.perform(restored)
+        self.client.metrics.observe('action_duration', time.monotonic() - start_time)
+        return await self._finalize_action(restored)
 
-            await self._ensure_minimum_sleep_time(start_time)
+    def annotate(self, parent):
+        """records the result of a non-mutating button as a leaf of parent without contacting the bot"""
+        from StateNode import StateNode
+        self.client.total += 1
+        self.client.metrics.inc('states')
+        return StateNode(self.client.total, parent=parent, action_in=self, text=self._local_text(),
+                         actions_out=[], status='local')
 
-        return await self._finalize_action(restored)
+    def _local_text(self):
+        if self.url is not None:
+            return self.url
+        return '\n'.join(self._collect_attrs())
 
     def _collect_attrs(self):
         target_attrs = ['url']
@@ -341,20 +443,6 @@ class PushInlineButtonAction(BaseTelegramAction):
 
     async def request_callback_answer(self):
         try:
-            logger = logging.getLogger('pyrogram.session.session')
-            current_level = logger.getEffectiveLevel()
-            logger.setLevel(logging.DEBUG)
-            if not logger.hasHandlers():
-                console_handler = logging.StreamHandler()
-                logger.addHandler(console_handler)
-                logger.propagate = False
-                file_handler = logging.FileHandler("yaml_logs.yaml", encoding="utf-8-sig")
-                file_handler.setLevel(logging.DEBUG)
-                from BotFuzzer.Tester import YamlLikeFormatter
-                formatter = YamlLikeFormatter()
-                file_handler.setFormatter(formatter)
-                logger.addHandler(file_handler)
-
             self.client.tester_logger.debug(f"Request_callback_answer from message {self.message_id}")
             await self.client.request_callback_answer(
                 self.target_chat,
@@ -362,7 +450,6 @@ class PushInlineButtonAction(BaseTelegramAction):
                 callback_data=self.callback_data,
                 retries=0
             )
-            logger.setLevel(current_level)
         except TimeoutError as e:
             self.client.tester_logger.debug(e)
         await asyncio.wait_for(self.response_event.wait(), timeout=self.client.max_time_to_wait)
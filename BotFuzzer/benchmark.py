@@ -0,0 +1,283 @@
+"""
+Synthetic large-tree benchmark for the exporters.
+
+Run from the repository root (the drawio font path is relative to it):
+
+    python BotFuzzer/benchmark.py --depth 5 --fanout 6 --modes json tree matrix
+
+Every run is appended to a history file, and the results are compared with the
+last run that used the same tree parameters, so exporter regressions are caught.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import string
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+
+from PIL import Image
+
+from StateNode import StateNode
+from actions import SendTextMessageAction
+from export import Exporter
+
+MODES = ('json', 'tree', 'matrix', 'html')
+STATUSES = ('ok', 'ok', 'ok', 'ok', 'Timeout', 'Loop!')
+
+
+class SyntheticTreeBuilder:
+    """builds StateNode trees that look like the ones produced by Tester"""
+
+    def __init__(self, depth=4, fanout=5, min_text_len=20, max_text_len=400,
+                 photo_share=0.1, video_share=0.02, seed=0, media_dir=None):
+        self.depth = depth
+        self.fanout = fanout
+        self.min_text_len = min_text_len
+        self.max_text_len = max_text_len
+        self.photo_share = photo_share
+        self.video_share = video_share
+        self.random = random.Random(seed)
+        self.media_dir = media_dir or tempfile.mkdtemp(prefix='botfuzzer_bench_')
+        # actions only need a target_bot to be constructed, no connection is made
+        self.client = SimpleNamespace(target_bot='@benchmark_bot')
+        self.total = -1
+        self._photos = []
+        self._videos = []
+
+    def build(self):
+        self._prepare_media()
+        root = self._new_node(parent=None, action_in=None, depth=0)
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node.depth >= self.depth:
+                continue
+            for action in node.actions_out:
+                child = self._new_node(parent=node, action_in=action, depth=node.depth + 1)
+                stack.append(child)
+        return root
+
+    def _new_node(self, parent, action_in, depth):
+        self.total += 1
+        if self.total == 0:
+            actions_out = [SendTextMessageAction(self.client, '/start')]
+            return StateNode(self.total, actions_out=actions_out)
+
+        fanout = self.fanout if depth < self.depth else 0
+        actions_out = [
+            SendTextMessageAction(self.client, self._random_text(3, 20))
+            for _ in range(fanout)
+        ]
+        return StateNode(
+            self.total,
+            parent=parent,
+            action_in=action_in,
+            text=self._random_text(self.min_text_len, self.max_text_len),
+            media=self._random_media(),
+            actions_out=actions_out,
+            status=self.random.choice(STATUSES),
+        )
+
+    def _random_text(self, min_len, max_len):
+        length = self.random.randint(min_len, max(min_len, max_len))
+        words = []
+        while sum(len(word) + 1 for word in words) < length:
+            word_len = self.random.randint(1, 12)
+            words.append(''.join(self.random.choices(string.ascii_letters, k=word_len)))
+        if len(words) > 4 and self.random.random() < 0.3:
+            words[len(words) // 2] += '\n'
+        return ' '.join(words)[:length]
+
+    def _random_media(self):
+        roll = self.random.random()
+        if roll < self.photo_share:
+            return self.random.choice(self._photos)
+        if roll < self.photo_share + self.video_share:
+            return self.random.choice(self._videos)
+        return None
+
+    def _prepare_media(self):
+        # a handful of distinct files is enough, exporters re-read them for every cell
+        for i, size in enumerate(((320, 240), (800, 600), (1280, 720))):
+            path = os.path.join(self.media_dir, f'photo{i}.jpg')
+            Image.new('RGB', size, color=(40 * i, 90, 160)).save(path, format='JPEG')
+            self._photos.append(path)
+
+            # exporters look for the converted .webp next to a video file
+            webp_path = os.path.join(self.media_dir, f'video{i}.webp')
+            Image.new('RGB', (size[0] // 2, size[1] // 2), color=(160, 40 * i, 90)).save(webp_path, format='WEBP')
+            video_path = os.path.join(self.media_dir, f'video{i}.mp4')
+            open(video_path, 'wb').close()
+            self._videos.append(video_path)
+
+
+def run_export(root, mode, processes=None):
+    """runs one export, returns the size of its output in bytes"""
+    exporter = Exporter(root)
+    if mode == 'json':
+        return len(exporter.export_to_json().encode('utf-8'))
+    if mode == 'html':
+        directory = exporter.export_to_html(tempfile.mkdtemp(prefix='botfuzzer_report_'))
+        size = sum(os.path.getsize(os.path.join(path, name))
+                   for path, _, names in os.walk(directory) for name in names)
+        shutil.rmtree(directory)
+        return size
+    filename = exporter.export_to_drawio(mode=mode, processes=processes)
+    size = os.path.getsize(filename)
+    os.remove(filename)
+    return size
+
+
+def measure(root, mode, repeat=1, processes=None):
+    timings = []
+    size = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        size = run_export(root, mode, processes)
+        timings.append(time.perf_counter() - start)
+
+    # separate pass, tracemalloc slows the export down too much to time it
+    gc.collect()
+    tracemalloc.start()
+    run_export(root, mode, processes)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'wall_time': min(timings),
+        'peak_memory': peak,
+        'output_size': size,
+    }
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_baseline(history, params):
+    for entry in reversed(history):
+        if entry.get('params') == params:
+            return entry
+    return None
+
+
+def compare(results, baseline, threshold):
+    """returns list of human-readable regressions against baseline"""
+    regressions = []
+    if baseline is None:
+        return regressions
+    for mode, metrics in results.items():
+        previous = baseline['results'].get(mode)
+        if previous is None:
+            continue
+        for metric in ('wall_time', 'peak_memory', 'output_size'):
+            if not previous.get(metric):
+                continue
+            change = (metrics[metric] - previous[metric]) / previous[metric]
+            if change > threshold:
+                regressions.append(f'{mode}.{metric}: {previous[metric]:.4g} -> {metrics[metric]:.4g} '
+                                   f'(+{change:.0%})')
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_size(num):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if num < 1024:
+            return f'{num:.1f} {unit}'
+        num /= 1024
+    return f'{num:.1f} TB'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark BotFuzzer exporters on synthetic trees')
+    parser.add_argument('--depth', type=int, default=4, help='depth of the synthetic tree')
+    parser.add_argument('--fanout', type=int, default=5, help='actions per state')
+    parser.add_argument('--min-text-len', type=int, default=20)
+    parser.add_argument('--max-text-len', type=int, default=400)
+    parser.add_argument('--photo-share', type=float, default=0.1, help='share of states with a photo')
+    parser.add_argument('--video-share', type=float, default=0.02, help='share of states with a video')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes rendering drawio tables, rendered in this process by default')
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs per mode, the best one is reported')
+    parser.add_argument('--history', default='benchmark_history.jsonl',
+                        help='file to append results to, empty string disables it')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    params = {
+        'depth': args.depth,
+        'fanout': args.fanout,
+        'min_text_len': args.min_text_len,
+        'max_text_len': args.max_text_len,
+        'photo_share': args.photo_share,
+        'video_share': args.video_share,
+        'seed': args.seed,
+    }
+
+    builder = SyntheticTreeBuilder(**params)
+    if args.processes:
+        # part of the parameters, so a parallel run is only compared with parallel runs
+        params['processes'] = args.processes
+    root = builder.build()
+    print(f'Synthetic tree: {builder.total + 1} states, depth {args.depth}, fanout {args.fanout}')
+
+    results = {}
+    for mode in args.modes:
+        results[mode] = measure(root, mode, repeat=args.repeat, processes=args.processes)
+        metrics = results[mode]
+        print(f'{mode:>7}: {metrics["wall_time"]:8.3f} s  '
+              f'peak {format_size(metrics["peak_memory"]):>10}  '
+              f'output {format_size(metrics["output_size"]):>10}')
+
+    regressions = []
+    if args.history:
+        history = load_history(args.history)
+        regressions = compare(results, find_baseline(history, params), args.threshold)
+        entry = {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'states': builder.total + 1,
+            'params': params,
+            'results': results,
+        }
+        with open(args.history, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+
+    if regressions and args.fail_on_regression:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,199 @@
+"""
+Command line interface of BotFuzzer.
+
+    python BotFuzzer/cli.py explore --target-bot @my_bot --max-depth 3
+    python BotFuzzer/cli.py explore --config run.toml --action-budget 50 --export json
+    python BotFuzzer/cli.py resume tree_2024-10-26_19-51-51.json --config run.toml
+    python BotFuzzer/cli.py export tree_2024-10-26_19-51-51.json --export drawio-tree html
+
+Options of Tester.create come from a JSON or TOML config file, flags override it, and any other option
+can be set with --option key=value. Heavy modules (pyrogram, openai, moviepy, PIL) are imported only by
+the subcommands that need them, so --help and exports of saved trees start quickly.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import traceback
+
+EXPORTS = {
+    'json': ('save_json', {}),
+    'json-flat': ('save_json', {'flat': True}),
+    'drawio-tree': ('export_to_drawio', {'mode': 'tree'}),
+    'drawio-matrix': ('export_to_drawio', {'mode': 'matrix'}),
+    'html': ('export_to_html', {}),
+}
+DEFAULT_EXPORTS = ['drawio-tree', 'drawio-matrix', 'json']
+
+
+def load_config(path):
+    """options of Tester.create from a JSON or, by extension, TOML file"""
+    if path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            # tomllib is part of the standard library since Python 3.11
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise SystemExit('botfuzzer: error: TOML configs need Python 3.11 or the tomli package '
+                                 '(pip install tomli), or use a JSON config') from None
+
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def parse_option(value):
+    """key=value, the value is parsed as JSON when it is valid JSON and taken as a string otherwise"""
+    key, separator, raw = value.partition('=')
+    if not separator or not key:
+        raise argparse.ArgumentTypeError(f"expected key=value, got {value!r}")
+    try:
+        return key.replace('-', '_'), json.loads(raw)
+    except ValueError:
+        return key.replace('-', '_'), raw
+
+
+def _add_export_argument(parser, default):
+    parser.add_argument('--export', nargs='*', choices=list(EXPORTS), default=default, metavar='FORMAT',
+                        help=f"formats to export: {', '.join(EXPORTS)}")
+    parser.add_argument('--processes', type=int, default=None, help='worker processes rendering drawio exports')
+    parser.add_argument('--collapse-chains', dest='collapse_chains', action='store_true',
+                        help='draw linear chains of states as one table in drawio tree exports')
+
+
+def _add_tester_arguments(parser):
+    # only given flags end up in the namespace, so they override the config file and nothing else
+    options = parser.add_argument_group('tester options')
+    options.add_argument('--config', help='JSON or TOML file with options of Tester.create')
+    options.add_argument('--target-bot', dest='target_bot', default=argparse.SUPPRESS)
+    options.add_argument('--name', default=argparse.SUPPRESS, help='pyrogram session name')
+    options.add_argument('--max-depth', dest='max_depth', type=int, default=argparse.SUPPRESS)
+    options.add_argument('--min-time-to-wait', dest='min_time_to_wait', type=float, default=argparse.SUPPRESS)
+    options.add_argument('--max-time-to-wait', dest='max_time_to_wait', type=float, default=argparse.SUPPRESS)
+    options.add_argument('--strategy', choices=['dfs', 'bfs', 'best_first'], default=argparse.SUPPRESS)
+    options.add_argument('--time-budget', dest='time_budget', type=float, default=argparse.SUPPRESS)
+    options.add_argument('--action-budget', dest='action_budget', type=int, default=argparse.SUPPRESS)
+    options.add_argument('--metrics-file', dest='metrics_file', default=argparse.SUPPRESS)
+    options.add_argument('--log-file', dest='log_file', default=argparse.SUPPRESS)
+    options.add_argument('--in-memory-session', dest='in_memory_session', action='store_true',
+                         default=argparse.SUPPRESS)
+    options.add_argument('--debug', action='store_true', default=argparse.SUPPRESS)
+    options.add_argument('--option', dest='extra_options', type=parse_option, action='append', default=[],
+                         metavar='KEY=VALUE', help='any other option of Tester.create, e.g. --option max_repeats=2')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='botfuzzer', description='Explore Telegram bots and export state trees')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    explore = subparsers.add_parser('explore', help='explore a bot from /start')
+    _add_tester_arguments(explore)
+    _add_export_argument(explore, DEFAULT_EXPORTS)
+
+    resume = subparsers.add_parser('resume', help='revisit a saved tree and explore what it left out')
+    resume.add_argument('tree', help='JSON tree of a previous run')
+    resume.add_argument('--diff', default=None, help='file of the differences to the previous run')
+    _add_tester_arguments(resume)
+    _add_export_argument(resume, DEFAULT_EXPORTS)
+
+    export = subparsers.add_parser('export', help='export a saved tree without contacting Telegram')
+    export.add_argument('tree', help='JSON tree of a previous run')
+    export.add_argument('--prefix', default='', help='prepended to the names of exported files')
+    _add_export_argument(export, ['drawio-tree'])
+    return parser.parse_args(argv)
+
+
+def tester_options(args):
+    """options of Tester.create: the config file, overridden by flags"""
+    options = load_config(args.config) if args.config else {}
+    skipped = {'command', 'config', 'extra_options', 'export', 'processes', 'collapse_chains', 'tree', 'diff'}
+    options.update((key, value) for key, value in vars(args).items() if key not in skipped)
+    options.update(args.extra_options)
+    if 'target_bot' not in options:
+        raise SystemExit('botfuzzer: error: target_bot is required, pass --target-bot or set it in the config')
+    return options
+
+
+def export_kwargs(export_format, args):
+    export, kwargs = EXPORTS[export_format]
+    if export == 'export_to_drawio':
+        kwargs = dict(kwargs, processes=args.processes)
+        if args.collapse_chains and kwargs['mode'] == 'tree':
+            kwargs['collapse_chains'] = True
+    return export, kwargs
+
+
+def run_exports(exporter, args):
+    for export_format in args.export:
+        export, kwargs = export_kwargs(export_format, args)
+        logging.info(f'{export_format}: {getattr(exporter, export)(**kwargs)}')
+
+
+async def submit_exports(exporter, args):
+    """renders the formats in parallel from one snapshot of the tree"""
+    futures = []
+    for export_format in args.export:
+        export, kwargs = export_kwargs(export_format, args)
+        futures.append(exporter.submit(export, **kwargs))
+    for export_format, result in zip(args.export, await asyncio.gather(*futures, return_exceptions=True)):
+        if isinstance(result, Exception):
+            logging.error(f'{export_format} export failed: {result!r}')
+        else:
+            logging.info(f'{export_format}: {result}')
+
+
+async def run_explore(args):
+    from Tester import Tester
+
+    tester = await Tester.create(**tester_options(args))
+    async with tester:
+        try:
+            await tester.test(target_node=tester.root)
+        except Exception as e:
+            traceback.print_exc()
+            print(f'ERROR: {e}')
+        finally:
+            await submit_exports(tester.exporter, args)
+    return 0
+
+
+async def run_resume(args):
+    from Tester import Tester
+    from regression import RegressionRunner
+
+    tester = await Tester.create(**tester_options(args))
+    async with tester:
+        try:
+            diff = await RegressionRunner.from_file(tester, args.tree, explore_unvisited=True).run()
+            logging.info(f"Differences to the previous run saved to {diff.save(args.diff)}")
+        except Exception as e:
+            traceback.print_exc()
+            print(f'ERROR: {e}')
+        finally:
+            await submit_exports(tester.exporter, args)
+    return 0
+
+
+def run_export(args):
+    from export import Exporter
+    from regression import load_tree
+
+    run_exports(Exporter(load_tree(args.tree), prefix=args.prefix), args)
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.command == 'export':
+        return run_export(args)
+    if args.command == 'resume':
+        return asyncio.run(run_resume(args))
+    return asyncio.run(run_explore(args))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
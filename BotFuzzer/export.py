@@ -1,29 +1,65 @@
+import asyncio
 import base64
+import io
 import json
 import os
+import threading
+import time
 import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from functools import reduce
+from functools import partial, reduce
+from types import SimpleNamespace
 from xml.sax.saxutils import escape
 
 from PIL import ImageFont, Image, ImageDraw
-from anytree import PreOrderIter, NodeMixin
-from anytree.exporter import JsonExporter, DictExporter
-from actions import BaseTelegramAction
+from anytree import NodeMixin
+from actions import RecordedAction
+from html_constants import MAX_LABEL_LEN, REPORT_CHUNK_SIZE, REPORT_DATA, REPORT_PAGE, THUMBNAIL_SIZE
+from StateNode import StateNode
+from index import tokenize
+from json_writer import write_flat, write_tree
+from layout import layout_tree, preorder
+from media import media_path
 from xml_constants import *
 
 
-class CustomEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, BaseTelegramAction):
-            return repr(obj)
-        return super().default(obj)
+# shared by all exporters, created on the first background export
+_EXECUTORS = {}
+EXECUTOR_WORKERS = 4
+PRERENDER_CHUNK_SIZE = 200
+_reserved_names = set()
+_reserved_names_lock = threading.Lock()
+
+
+def reserve_name(base_name, extension):
+    """file name that no other export uses, parallel exports started in the same second get a counter"""
+    with _reserved_names_lock:
+        name = base_name
+        counter = 1
+        while name in _reserved_names or os.path.exists(name + extension) or os.path.exists(f"{name}_page1{extension}"):
+            counter += 1
+            name = f"{base_name}_{counter}"
+        _reserved_names.add(name)
+        return name
+
+
+def prerender_chunk(chunk):
+    """renders cells of the tables of a chunk of states in a worker process, states are given by row_items()"""
+    rendered = []
+    for items in chunk:
+        table = SimpleNamespace(id=None)
+        rows = [Row(key, value, table=table, index=i) for i, (key, value) in enumerate(items)]
+        rendered.append([[(cell.value, cell.cell_height) for cell in row.cells] for row in rows])
+    return rendered
 
 
 class Table(NodeMixin):
     """drawio table"""
 
-    def __init__(self, origin, parent=None):
+    def __init__(self, origin, parent=None, rendered=None, folded=None):
         self.id = origin.state_id
         self.origin = origin
         self.table_x = None
@@ -33,20 +69,38 @@ class Table(NodeMixin):
         self.rows = []
         self.parent = parent
         self.edge = None if parent is None else Edge(parent.id, self.id)
-        self.__prerender()
+        self.__prerender(rendered, folded)
 
-    def __prerender(self):
-        counter = 0
+    @staticmethod
+    def row_items(origin, portable=False):
+        """
+        (key, value) of the rows of a state, in the order of the table.
+
+        portable values are strings or lists of strings, rendered the same way, to be sent to worker processes.
+        """
         order = ["state_id", "action_in", "status", "media", "text", "actions_out"]
         sorted_items = sorted(
-            self.origin.__dict__.items(),
+            origin.__dict__.items(),
             key=lambda item: order.index(item[0]) if item[0] in order else len(order),
         )
-
-        for key, value in sorted_items:
-            if key not in ("_NodeMixin__children", "_NodeMixin__parent"):
-                self.rows.append(Row(key, value, table=self, index=counter))
-                counter += 1
+        items = [(key, media_path(value) if key == "media" else value) for key, value in sorted_items
+                 if key not in ("_NodeMixin__children", "_NodeMixin__parent")]
+        if portable:
+            items = [(key, list(map(str, value)) if isinstance(value, list) else value
+                      if isinstance(value, str) else str(value)) for key, value in items]
+        return items
+
+    def __prerender(self, rendered=None, folded=None):
+        # rendered are cells prepared by prerender_chunk() in a worker process
+        for counter, (key, value) in enumerate(self.row_items(self.origin)):
+            self.rows.append(Row(key, value, table=self, index=counter,
+                                 rendered=rendered[counter] if rendered is not None else None))
+        if folded:
+            # states of a linear chain drawn as this one table, the last row lists the others
+            lines = [f"{node.state_id}: {node.action_in} -> {str(node.text)[:FOLDED_TEXT_LEN]}" for node in folded]
+            if len(lines) > 2 * FOLDED_LISTED:
+                lines[FOLDED_LISTED:-FOLDED_LISTED] = [f"... {len(lines) - 2 * FOLDED_LISTED} more states ..."]
+            self.rows.append(Row("folded_states", lines, table=self, index=len(self.rows)))
 
         self.table_height = reduce(
             lambda height, row: height + row.row_height, self.rows, 0
@@ -62,9 +116,12 @@ class Table(NodeMixin):
 class Row:
     """drawio row"""
 
-    def __init__(self, key, value, table, index):
+    def __init__(self, key, value, table, index, rendered=None):
         self.id = f"{table.id}-{index + 1}"
-        self.cells = [Cell(self, key, 0), Cell(self, value, 1)]
+        if rendered is None:
+            self.cells = [Cell(self, key, 0), Cell(self, value, 1)]
+        else:
+            self.cells = [Cell(self, key, 0, rendered[0]), Cell(self, value, 1, rendered[1])]
         self.row_y = 0
         self.row_width = BASE_TABLE_WIDTH
         self.row_height = max([cell.cell_height for cell in self.cells])
@@ -81,7 +138,7 @@ class Row:
 class Cell:
     """drawio cell"""
 
-    def __init__(self, row, value, index):
+    def __init__(self, row, value, index, rendered=None):
         self.id = f"{row.id}-{index + 1}"
         self.value = value
         self.cell_x = 0 if index == 0 else BASE_TABLE_WIDTH * BASE_CELL_SHARE
@@ -90,7 +147,10 @@ class Cell:
         )
         self.cell_height = None
         self.parent = row
-        self.__prerender()
+        if rendered is None:
+            self.__prerender()
+        else:
+            self.value, self.cell_height = rendered
 
     def __prerender(self):
         if isinstance(self.value, str) and os.path.exists(self.value):
@@ -160,11 +220,7 @@ class Cell:
         max_width=BASE_TABLE_WIDTH * (1 - BASE_CELL_SHARE),
     ):
 
-        font_path = os.path.abspath(font_path)
-        font = ImageFont.truetype(font_path, font_size)
-
-        dummy_image = Image.new("RGB", (1, 1))
-        draw = ImageDraw.Draw(dummy_image)
+        font, draw = _measuring_tools(os.path.abspath(font_path), font_size)
 
         lines = []
         for line in text.split("\n"):
@@ -194,6 +250,20 @@ class Cell:
         return self.value == other.value
 
 
+_measuring = threading.local()
+
+
+def _measuring_tools(font_path, font_size):
+    # loading the font took longer than measuring a cell; kept per thread, background exports measure concurrently
+    tools = getattr(_measuring, 'tools', None)
+    if tools is None:
+        tools = _measuring.tools = {}
+    key = (font_path, font_size)
+    if key not in tools:
+        tools[key] = ImageFont.truetype(font_path, font_size), ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    return tools[key]
+
+
 class Edge:
     """drawio edge to connect tables"""
 
@@ -203,29 +273,124 @@ class Edge:
         self.target = f"{target_id}-3"
 
 
+class Stub(NodeMixin):
+    """drawio cell linking to the page a subtree continues on"""
+
+    def __init__(self, label, link, parent=None, stub_id=None):
+        self.id = stub_id or f"stub-{uuid.uuid4()}"
+        self.label = escape(label, {'"': "&quot;", "'": "&apos;", "\n": "&lt;br&gt;"})
+        self.link = escape(link, {'"': "&quot;"})
+        self.table_x = BASE_START_TABLE_X_AXIS
+        self.table_y = None
+        self.table_width = BASE_TABLE_WIDTH
+        self.table_height = STUB_HEIGHT
+        self.rows = []
+        self.parent = parent
+
+    def to_xml(self):
+        return BASE_STUB.format(self.label, self.link, self.id, self.table_x, self.table_y,
+                                self.table_width, self.table_height)
+
+
+class TreeSnapshot:
+    """
+    copy of a state tree that background exports render while exploration goes on.
+
+    The tree is copied into flat records first, which travel to worker processes without the recursion of
+    pickling nested nodes, and the snapshot is rebuilt from them. States keep their attributes in the same
+    order, actions become RecordedActions, so exports of a snapshot are the same as exports of the live tree.
+    """
+
+    def __init__(self, records):
+        nodes = []
+        for state_id, parent, attrs in records:
+            nodes.append(StateNode(
+                state_id,
+                parent=nodes[parent] if parent is not None else None,
+                action_in=RecordedAction(*attrs['action_in']) if attrs['action_in'] is not None else None,
+                text=attrs['text'],
+                media=attrs['media'],
+                actions_out=[RecordedAction(*action) for action in attrs['actions_out']],
+                status=attrs['status'],
+            ))
+        self.root = nodes[0]
+
+    @staticmethod
+    def records(root):
+        """(state_id, position of the parent record, attributes) of every state, in preorder"""
+        positions = {}
+        records = []
+        for node in preorder(root):
+            positions[id(node)] = len(records)
+            records.append((
+                node.state_id,
+                positions[id(node.parent)] if node is not root else None,
+                {
+                    'action_in': (node.action_in.kind, node.action_in.text) if node.action_in is not None else None,
+                    'text': node.text,
+                    'media': media_path(node.media),
+                    'actions_out': [(action.kind, action.text) for action in node.actions_out or []],
+                    'status': node.status,
+                },
+            ))
+        return records
+
+
+def _export_snapshot(records, prefix, export, args, kwargs):
+    """runs an export of the tree rebuilt from records, in a worker thread or process"""
+    return getattr(Exporter(TreeSnapshot(records), prefix=prefix), export)(*args, **kwargs)
+
+
 class Exporter:
-    def __init__(self, tester):
+    def __init__(self, tester, metrics=None, prefix='', downloads=None):
         self.tester = tester
+        self.metrics = metrics
+        # media downloads of the run, background exports wait for the pending ones
+        self.downloads = downloads
+        # prepended to file names, so exports of several bots made in the same second don't collide
+        self.prefix = prefix
         self.render_root = None
         self.render_pool = []
         self.tree_width_by_levels = None
         self.mapping_state_tree_to_render_tree = {}
-
-    def _custom_attr_iter(self, node):
-        """custom function to process attrs of nodes for nice view"""
-        res = []
-        actions_out_item = None
-
-        for k, v in node:
-            v = str(v).strip("[]")
-            if k == "actions_out":
-                actions_out_item = (k, v)
-            else:
-                res.append((k, v))
-
-        if actions_out_item:
-            res.append(actions_out_item)
-        return res
+        # cells rendered by worker processes, id of a state -> cells of its rows
+        self.rendered = {}
+        self.collapse_chains = False
+
+    def submit(self, export, *args, executor='thread', **kwargs):
+        """
+        runs an export (a method name like 'export_to_drawio') in the background, returns an awaitable future.
+
+        The tree is copied first, once pending media downloads are done, so the export sees the tree as it was
+        then while the explorer goes on. executor='process' renders in a worker process, several exports can
+        run in parallel either way.
+        """
+        if executor == 'thread':
+            pool = _EXECUTORS.get('thread') or _EXECUTORS.setdefault(
+                'thread', ThreadPoolExecutor(EXECUTOR_WORKERS, thread_name_prefix='export'))
+        elif executor == 'process':
+            pool = _EXECUTORS.get('process') or _EXECUTORS.setdefault(
+                'process', ProcessPoolExecutor(EXECUTOR_WORKERS))
+        else:
+            raise ValueError(f'Unknown executor: {executor}')
+
+        # timed here, metrics don't travel to worker processes
+        name = kwargs.get('mode', 'tree') if export == 'export_to_drawio' else export.replace('export_to_', '')
+        started_at = time.monotonic()
+        future = asyncio.ensure_future(self._run_in(pool, export, args, kwargs))
+        if self.metrics is not None:
+            self.metrics.inc('exports')
+            future.add_done_callback(
+                lambda _: self.metrics.observe(f'export_{name}', time.monotonic() - started_at))
+        return future
+
+    async def _run_in(self, pool, export, args, kwargs):
+        if self.downloads is not None:
+            await self.downloads.join()
+        # the snapshot is taken in the event loop, where nothing changes the tree meanwhile
+        records = TreeSnapshot.records(self.tester.root)
+        return await asyncio.get_running_loop().run_in_executor(
+            pool, partial(_export_snapshot, records, self.prefix, export, args, kwargs))
 
     def get_element_from_list_safely(self, lst, index, default=None):
         try:
@@ -234,61 +399,54 @@ class Exporter:
             return default
 
     def _initialize_render_tree(self):
-        for node in PreOrderIter(self.tester.root):
-            if node.depth == 0:
-                self.render_root = Table(origin=self.tester.root)
-                self.render_pool.append(self.render_root)
-                self.mapping_state_tree_to_render_tree[node] = self.render_root
-            else:
-                render_node = Table(
-                    origin=node,
-                    parent=self.mapping_state_tree_to_render_tree[node.parent],
-                )
-                self.render_pool.append(render_node)
-                self.mapping_state_tree_to_render_tree[node] = render_node
+        root = self.tester.root
+        stack = [(root, None)]
+        while stack:
+            node, parent_table = stack.pop()
+            chain = self._fold_chain(node) if self.collapse_chains and node is not root else [node]
+            render_node = Table(
+                origin=chain[-1],
+                parent=parent_table,
+                rendered=self.rendered.get(id(chain[-1])),
+                folded=chain[:-1],
+            )
+            if parent_table is None:
+                self.render_root = render_node
+            self.render_pool.append(render_node)
+            for state in chain:
+                self.mapping_state_tree_to_render_tree[state] = render_node
+            stack.extend((child, render_node) for child in reversed(chain[-1].children))
+
+    @staticmethod
+    def _fold_chain(node, continues=None):
+        """
+        states of the linear chain starting at node, each but the last with a single child, if it is long enough
+        to be folded into one table; [node] otherwise. continues tells whether a child may join the chain.
+        """
+        chain = [node]
+        while len(chain[-1].children) == 1 and (continues is None or continues(chain[-1].children[0])):
+            chain.append(chain[-1].children[0])
+        return chain if len(chain) >= MIN_FOLDED_CHAIN else [node]
 
     def _initialize_render_matrix(self):
-        self.render_paths = []
-        for leaf in PreOrderIter(self.tester.root, filter_=lambda n: n.is_leaf):
-            path = []
-            previous_table = None
-            for node in leaf.path:
-                table = Table(origin=node)
-                if previous_table is not None:
-                    edge = Edge(previous_table.id, table.id)
-                    table.edge = edge
-                path.append(table)
-                previous_table = table
-            self.render_paths.append(path)
-
-    def _layout_render_tree(self, node, y_position):
-        # set table_x
-        node.table_x = (
-            BASE_START_TABLE_X_AXIS
-            + node.depth * BASE_TABLE_WIDTH
-            + node.depth * MARGIN
-        )
-
-        # layout rows within table
-        current_row_y = 0
-        for row in node.rows:
-            row.row_y = current_row_y
-            current_row_y += row.row_height
-
-        if not node.children:
-            node.table_y = y_position
-            return y_position + node.table_height + MARGIN
-
-        child_y_position = y_position
-
-        for child in node.children:
-            child_y_position = self._layout_render_tree(child, child_y_position)
-
-        min_child_y = node.children[0].table_y
-        max_child_y = node.children[-1].table_y + node.children[-1].table_height
-        node.table_y = (min_child_y + max_child_y) / 2 - node.table_height / 2
-
-        return max(child_y_position, node.table_y + node.table_height + MARGIN)
+        self.render_paths = list(self._iter_render_paths())
+
+    def _iter_render_paths(self):
+        for leaf in (node for node in preorder(self.tester.root) if node.is_leaf):
+            yield self._render_path(leaf, self.rendered)
+
+    @staticmethod
+    def _render_path(leaf, rendered=None):
+        path = []
+        previous_table = None
+        for node in leaf.path:
+            table = Table(origin=node, rendered=rendered.get(id(node)) if rendered else None)
+            if previous_table is not None:
+                edge = Edge(previous_table.id, table.id)
+                table.edge = edge
+            path.append(table)
+            previous_table = table
+        return path
 
     def _layout_render_matrix(self, y_position):
         current_y_position = y_position
@@ -312,49 +470,48 @@ class Exporter:
             if max_table_height > 0:
                 current_y_position += max_table_height + MARGIN
 
-    def _fill_xml_with_tree(self, table):
-        main_str = ""
-        # add shape=table to xml
-        main_str += BASE_TABLE.format(
-            table.id,
-            table.table_x,
-            table.table_y,
-            table.table_width,
-            table.table_height,
-        )
-
-        # add shape=tableRow and shape=partialRectangle to xml
-        for row in table.rows:
-            main_str += BASE_ROW.format(
-                row.id, row.parent.id, row.row_y, row.row_width, row.row_height
-            )
-
-            main_str += BASE_CELL.format(
-                row.cells[0].id,
-                row.cells[0].value,
-                row.cells[0].parent.id,
-                row.cells[0].cell_x,
-                row.cells[0].cell_width,
-                row.cells[0].cell_height,
-            )
-
-            main_str += BASE_CELL.format(
-                row.cells[1].id,
-                row.cells[1].value,
-                row.cells[1].parent.id,
-                row.cells[1].cell_x,
-                row.cells[1].cell_width,
-                row.cells[1].cell_height,
-            )
-
-        if table.children:
-            for index, child in enumerate(table.children):
-                main_str += self._fill_xml_with_tree(child)
-
-        if table.parent:
-            main_str += BASE_EDGE.format(str(uuid.uuid4()), table.parent.id, table.id)
-
-        return main_str
+    def _fill_xml_with_tree(self, root):
+        parts = []
+        # tables in preorder, the edge to a table follows its subtree; strings on the stack are written as they are
+        stack = [root]
+        while stack:
+            table = stack.pop()
+            if isinstance(table, str):
+                parts.append(table)
+                continue
+            if isinstance(table, Stub):
+                parts.append(table.to_xml() + BASE_EDGE.format(str(uuid.uuid4()), table.parent.id, table.id))
+                continue
+
+            # add shape=table to xml
+            parts.append(BASE_TABLE.format(
+                table.id,
+                table.table_x,
+                table.table_y,
+                table.table_width,
+                table.table_height,
+            ))
+
+            # add shape=tableRow and shape=partialRectangle to xml
+            for row in table.rows:
+                parts.append(BASE_ROW.format(
+                    row.id, row.parent.id, row.row_y, row.row_width, row.row_height
+                ))
+                for cell in row.cells:
+                    parts.append(BASE_CELL.format(
+                        cell.id,
+                        cell.value,
+                        cell.parent.id,
+                        cell.cell_x,
+                        cell.cell_width,
+                        cell.cell_height,
+                    ))
+
+            if table.parent:
+                stack.append(BASE_EDGE.format(str(uuid.uuid4()), table.parent.id, table.id))
+            stack.extend(reversed(table.children))
+
+        return "".join(parts)
 
     def _fill_xml_with_matrix(self):
         main_str = ""
@@ -390,40 +547,380 @@ class Exporter:
         export_string = export_string.strip("\n")
         current_time = datetime.now()
         formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S")
-        filename = f"tree_{mode}_{formatted_time}.xml"
+        filename = reserve_name(f"{self.prefix}tree_{mode}_{formatted_time}", ".xml") + ".xml"
         with open(filename, "w", encoding="utf-8") as f:
             f.write(export_string)
-        return
-
-    def export_to_json(self, save=False):
-        exporter = JsonExporter(
-            indent=2,
-            ensure_ascii=False,
-            cls=CustomEncoder,
-            dictexporter=DictExporter(attriter=self._custom_attr_iter),
-        )
-
-        tree = exporter.export(self.tester.root)
-
-        if save:
-            current_time = datetime.now()
-            formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S")
-            filename = f"tree_{formatted_time}.json"
+        return filename
+
+    @contextmanager
+    def _timed(self, name):
+        if self.metrics is None:
+            yield
+            return
+        self.metrics.inc('exports')
+        with self.metrics.timer(f'export_{name}'):
+            yield
+
+    def export_to_json(self, save=False, flat=False):
+        """
+        returns the tree as JSON, save also writes it to a file.
+
+        flat gives a list of states referring to their parents instead of nested children.
+        """
+        with self._timed('json'):
+            buffer = io.StringIO()
+            self._write_json(buffer, flat)
+            tree = buffer.getvalue()
+            if save:
+                with open(self._json_filename(), "w", encoding="utf-8") as f:
+                    f.write(tree)
+            return tree
+
+    def save_json(self, filename=None, flat=False):
+        """streams the tree as JSON straight into a file without building it in memory, returns the file name"""
+        with self._timed('json'):
+            filename = filename or self._json_filename()
             with open(filename, "w", encoding="utf-8") as f:
-                f.write(tree)
+                self._write_json(f, flat)
+            return filename
 
-        return tree
-
-    def export_to_drawio(self, mode='tree'):
+    def _write_json(self, stream, flat):
+        if flat:
+            write_flat(self.tester.root, stream)
+        else:
+            write_tree(self.tester.root, stream)
+
+    def _json_filename(self):
+        formatted_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        return reserve_name(f"{self.prefix}tree_{formatted_time}", ".json") + ".json"
+
+    def export_to_html(self, directory=None, chunk_size=REPORT_CHUNK_SIZE, thumbnail_size=THUMBNAIL_SIZE):
+        """
+        writes a static HTML report that opens without a server, returns its directory.
+
+        The page loads only a compact index of the tree; texts, actions and media thumbnails are in
+        chunks of chunk_size states loaded when a state is opened, the search index on the first search.
+        """
+        with self._timed('html'):
+            return self._export_to_html(directory, chunk_size, thumbnail_size)
+
+    def _export_to_html(self, directory, chunk_size, thumbnail_size):
+        if directory is None:
+            directory = f"{self.prefix}report_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+        os.makedirs(os.path.join(directory, 'chunks'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'media'), exist_ok=True)
+
+        ids, parents, labels, status_codes = [], [], [], []
+        statuses = {}
+        search_index = {}
+        index_of = {}
+        thumbnails = {}
+        chunk = []
+        for i, node in enumerate(preorder(self.tester.root)):
+            # states are numbered in preorder, so a subtree mostly lives in one or two chunks
+            index_of[id(node)] = i
+            ids.append(node.state_id)
+            parents.append(index_of[id(node.parent)] if node.parent is not None else -1)
+            labels.append(str(node.action_in)[:MAX_LABEL_LEN] if node.action_in is not None else '')
+            status_codes.append(statuses.setdefault(node.status, len(statuses)))
+
+            text = str(node.text or '')
+            for token in tokenize(text):
+                search_index.setdefault(token, []).append(i)
+            media = media_path(node.media)
+
+            chunk.append({
+                'id': node.state_id,
+                'text': text,
+                'media': media if isinstance(media, str) else None,
+                'thumbnail': self._make_thumbnail(media, directory, thumbnails, thumbnail_size),
+                'actions_out': [repr(action) for action in node.actions_out or []],
+            })
+            if len(chunk) == chunk_size:
+                self._write_report_data(directory, f'chunks/chunk_{i // chunk_size}.js', 'chunk', i // chunk_size, chunk)
+                chunk = []
+        if chunk:
+            self._write_report_data(directory, f'chunks/chunk_{len(ids) // chunk_size}.js', 'chunk',
+                                    len(ids) // chunk_size, chunk)
+
+        tree = {
+            'ids': ids,
+            'parents': parents,
+            'labels': labels,
+            'status': status_codes,
+            'statuses': list(statuses),
+        }
+        self._write_report_data(directory, 'tree.js', 'tree', '', tree)
+        self._write_report_data(directory, 'search.js', 'search', '', search_index)
+
+        title = escape(f"{self.prefix.rstrip('_') or 'BotFuzzer'} report, {len(ids)} states")
+        with open(os.path.join(directory, 'index.html'), 'w', encoding='utf-8') as f:
+            f.write(REPORT_PAGE.format(title=title, chunk_size=chunk_size))
+        return directory
+
+    @staticmethod
+    def _write_report_data(directory, name, kind, key, data):
+        with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+            f.write(REPORT_DATA.format(
+                json.dumps(kind), json.dumps(key), json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+            ))
+
+    @staticmethod
+    def _make_thumbnail(media, directory, thumbnails, size):
+        if not isinstance(media, str):
+            return None
+        # the same file is often sent as the answer to many actions
+        if media not in thumbnails:
+            thumbnails[media] = Exporter._save_thumbnail(media, directory, len(thumbnails), size)
+        return thumbnails[media]
+
+    @staticmethod
+    def _save_thumbnail(media, directory, index, size):
+        if not os.path.exists(media):
+            return None
+        extension = os.path.splitext(media)[1].lower()
+        if extension in ('.mp4', '.avi', '.mov', '.webp'):
+            # videos are converted to webp next to the original while downloading
+            media = media.rsplit('.', 1)[0] + '.webp'
+        elif extension not in ('.jpg', '.jpeg', '.png', '.gif'):
+            return None
+        thumbnail = f'media/{index}.jpg'
+        try:
+            with Image.open(media) as image:
+                image = image.convert('RGB')
+                image.thumbnail((size, size))
+                image.save(os.path.join(directory, thumbnail), format='JPEG', quality=80)
+        except (OSError, ValueError):
+            return None
+        return thumbnail
+
+    def export_to_drawio(self, mode='tree', split=None, page_depth=3, max_tables=1000, separate_files=False,
+                         processes=None, collapse_chains=False):
+        """
+        exports the tree to drawio, on one page by default.
+
+        split cuts a large tree into pages: 'subtree' puts every subtree starting at page_depth on its own page,
+        'depth' starts new pages every page_depth levels and 'size' keeps at most max_tables tables on a page
+        (the only split of the matrix mode). Stubs link to the page a subtree continues on. Pages go to one
+        file, or to one file each with separate_files, then a list of file names is returned.
+
+        processes renders the cells of tables (text measuring, images) in that many worker processes,
+        in chunks of PRERENDER_CHUNK_SIZE states; the layout is computed here afterwards.
+
+        collapse_chains draws linear chains of at least MIN_FOLDED_CHAIN states, every state but the last with a
+        single child, as one table of the last state listing the others (tree mode).
+        """
+        with self._timed(mode):
+            pool = ProcessPoolExecutor(processes) if processes else None
+            self.collapse_chains = collapse_chains
+            try:
+                if split is None:
+                    return self._export_to_drawio(mode, pool)
+                return self._export_to_drawio_pages(mode, split, page_depth, max_tables, separate_files, pool)
+            finally:
+                self.rendered = {}
+                self.collapse_chains = False
+                if pool is not None:
+                    pool.shutdown()
+
+    def _prerender(self, nodes, pool):
+        """renders the cells of states in worker processes, a chunk of states per task"""
+        if pool is None:
+            return
+        nodes = [node for node in nodes if id(node) not in self.rendered]
+        chunks = [nodes[i:i + PRERENDER_CHUNK_SIZE] for i in range(0, len(nodes), PRERENDER_CHUNK_SIZE)]
+        items = ([Table.row_items(node, portable=True) for node in chunk] for chunk in chunks)
+        for chunk, rendered in zip(chunks, pool.map(prerender_chunk, items)):
+            for node, cells in zip(chunk, rendered):
+                self.rendered[id(node)] = cells
+
+    def _export_to_drawio(self, mode, pool=None):
+        if mode not in ('tree', 'matrix'):
+            raise ValueError('Unknown mode')
+        self._prerender(preorder(self.tester.root), pool)
         if mode == 'tree':
             self._initialize_render_tree()
-            self._layout_render_tree(self.render_root, BASE_START_TABLE_Y_AXIS)
+            layout_tree(self.render_root, BASE_START_TABLE_Y_AXIS)
             main_str = self._fill_xml_with_tree(self.render_root)
-            self._save_xml_file(main_str, mode)
+            return self._save_xml_file(main_str, mode)
         elif mode == 'matrix':
             self._initialize_render_matrix()
             self._layout_render_matrix(BASE_START_TABLE_Y_AXIS)
             main_str = self._fill_xml_with_matrix()
-            self._save_xml_file(main_str, mode)
+            return self._save_xml_file(main_str, mode)
+
+    def _export_to_drawio_pages(self, mode, split, page_depth, max_tables, separate_files, pool=None):
+        if mode == 'tree':
+            if split not in ('subtree', 'depth', 'size'):
+                raise ValueError(f'Unknown split: {split}')
+            pages = self._split_tree(split, page_depth, max_tables)
+            render_page = self._render_tree_page
+        elif mode == 'matrix':
+            if split != 'size':
+                raise ValueError('Matrix mode can only be split by size')
+            pages = self._split_matrix(max_tables)
+            render_page = self._render_matrix_page
         else:
             raise ValueError('Unknown mode')
+
+        formatted_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        base_name = reserve_name(f"{self.prefix}tree_{mode}_{formatted_time}", ".xml")
+        if separate_files:
+            links = [f"{base_name}_page{i + 1}.xml" for i in range(len(pages))]
+        else:
+            links = [f"data:page/id,page-{i + 1}" for i in range(len(pages))]
+
+        # pages are laid out and written one by one, only one page is held in memory
+        filenames = []
+        f = None
+        try:
+            for i, page in enumerate(pages):
+                if f is None or separate_files:
+                    if f is not None:
+                        f.write(BASE_FILE_END)
+                        f.close()
+                    filenames.append(links[i] if separate_files else f"{base_name}.xml")
+                    f = open(filenames[-1], "w", encoding="utf-8")
+                    f.write(BASE_FILE_START)
+                if mode == 'tree':
+                    self._prerender(page[1], pool)
+                else:
+                    self._prerender({id(node): node for leaf in page for node in leaf.path}.values(), pool)
+                f.write(BASE_DIAGRAM.format(f"page-{i + 1}", f"Page-{i + 1}", render_page(page, links)))
+                # only the cells of the page being written are kept
+                self.rendered = {}
+            if f is not None:
+                f.write(BASE_FILE_END)
+        finally:
+            if f is not None:
+                f.close()
+        return filenames if separate_files else filenames[0]
+
+    def _split_tree(self, split, page_depth, max_tables):
+        """
+        assigns states to pages, returns (page roots, states, stub pages, parent page) in page order.
+
+        Subtrees cut off one page continue together on the next one while they fit into max_tables,
+        except for the 'subtree' split, which gives every subtree a page of its own.
+        """
+        root = self.tester.root
+        subtree_sizes = {}
+        for node in reversed(preorder(root)):
+            subtree_sizes[node.state_id] = 1 + sum(subtree_sizes[child.state_id] for child in node.children)
+
+        pages = []
+        pending = deque([([root], None)])
+        page_index = {}
+        while pending:
+            page_roots, parent_page = pending.popleft()
+            for page_root in page_roots:
+                page_index[page_root.state_id] = len(pages)
+            states = []
+            stubs = []
+            queue = deque(page_roots)
+            # breadth-first, so the top of a subtree stays together when the size budget runs out
+            while queue:
+                node = queue.popleft()
+                states.append(node)
+                for child in node.children:
+                    if split == 'subtree':
+                        starts_page = node.depth < page_depth <= child.depth
+                    elif split == 'depth':
+                        starts_page = child.depth % page_depth == 0
+                    else:
+                        starts_page = len(states) + len(queue) >= max_tables
+                    if starts_page:
+                        stubs.append(child)
+                    else:
+                        queue.append(child)
+
+            group = []
+            group_size = 0
+            for stub in stubs:
+                size = subtree_sizes[stub.state_id]
+                if group and (split == 'subtree' or group_size + size > max_tables):
+                    pending.append((group, len(pages)))
+                    group = []
+                    group_size = 0
+                group.append(stub)
+                group_size += size
+            if group:
+                pending.append((group, len(pages)))
+            pages.append([page_roots, states, stubs, parent_page])
+
+        for page in pages:
+            page[2] = {stub.state_id: page_index[stub.state_id] for stub in page[2]}
+        return pages
+
+    def _render_tree_page(self, page, links):
+        page_roots, states, stub_pages, parent_page = page
+        on_page = {state.state_id for state in states}
+
+        render_roots = []
+        stack = [(page_root, None) for page_root in reversed(page_roots)]
+        while stack:
+            node, parent_table = stack.pop()
+            if node.state_id in stub_pages:
+                target_page = stub_pages[node.state_id]
+                label = f"{node.action_in}\nContinued on Page-{target_page + 1}"
+                Stub(label, links[target_page], parent=parent_table, stub_id=f"stub-{node.state_id}")
+                continue
+            chain = [node]
+            if self.collapse_chains and node is not self.tester.root:
+                # a chain stops at the page border
+                chain = self._fold_chain(
+                    node, lambda child: child.state_id in on_page and child.state_id not in stub_pages)
+            table = Table(origin=chain[-1], parent=parent_table, rendered=self.rendered.get(id(chain[-1])),
+                          folded=chain[:-1])
+            if parent_table is None:
+                render_roots.append(table)
+            stack.extend(
+                (child, table) for child in reversed(chain[-1].children)
+                if child.state_id in on_page or child.state_id in stub_pages
+            )
+
+        # subtrees continued on the same page are stacked one under another
+        main_str = ""
+        y_position = BASE_START_TABLE_Y_AXIS
+        for render_root in render_roots:
+            y_position = layout_tree(render_root, y_position)
+            main_str += self._fill_xml_with_tree(render_root)
+        if parent_page is not None:
+            back = Stub(f"Back to Page-{parent_page + 1}", links[parent_page], stub_id="stub-back")
+            back.table_y = BASE_START_TABLE_Y_AXIS - STUB_HEIGHT - MARGIN
+            main_str += back.to_xml()
+        return main_str
+
+    def _split_matrix(self, max_tables):
+        """groups leaves of the matrix into pages of at most max_tables drawn tables"""
+        pages = []
+        page = []
+        tables_on_page = 0
+        previous_path = ()
+        for leaf in (node for node in preorder(self.tester.root) if node.is_leaf):
+            path = leaf.path
+            # states shared with the previous path are drawn once, unless the path opens a page
+            shared = 0
+            while shared < min(len(path), len(previous_path)) and path[shared] is previous_path[shared]:
+                shared += 1
+            drawn = len(path) - shared
+            if page and tables_on_page + drawn > max_tables:
+                pages.append(page)
+                page = []
+                drawn = len(path)
+                tables_on_page = 0
+            page.append(leaf)
+            tables_on_page += drawn
+            previous_path = path
+        if page:
+            pages.append(page)
+        return pages
+
+    def _render_matrix_page(self, page, links):
+        # tables are only created for the page being written
+        self.render_paths = [self._render_path(leaf, self.rendered) for leaf in page]
+        self._layout_render_matrix(BASE_START_TABLE_Y_AXIS)
+        main_str = self._fill_xml_with_matrix()
+        self.render_paths = []
+        return main_str
+
@@ -0,0 +1,218 @@
+"""
+Fuzzing of free-text input.
+
+A corpus of inputs (boundary values, unicode, long text, commands) is sent to states of an explored tree that
+accept text. Responses are only probed, no states or media are created for them, and are clustered by the
+tester's state equivalence. Only an input producing a new class of response becomes a state of the tree and
+is explored further; inputs after which the bot stays in the fuzzed state are sent back-to-back without restores.
+"""
+import json
+import time
+from datetime import datetime
+
+from pyrogram.errors import RPCError
+
+from StateNode import StateNode
+from Tester import BudgetExhausted
+from actions import ActionFactory
+from regression import describe_path
+
+DEFAULT_CORPUS = (
+    'bla bla bla 111',
+    ' ',
+    '0',
+    '-1',
+    '2147483648',
+    '99999999999999999999999999999999',
+    '1e309',
+    'NaN',
+    '3.14',
+    'test@example.com',
+    '+10000000000',
+    '2024-02-30',
+    'null',
+    "' OR 1=1 --",
+    '<b>bold</b> <script>alert(1)</script>',
+    '%s%n%x {0} ${7*7} {{7*7}}',
+    '../../../../etc/passwd',
+    'Привет, мир',
+    'مرحبا بالعالم',
+    '你好世界',
+    '👍🏽👨‍👩‍👧‍👦🏳️‍🌈',
+    'Z̴̡̛a̷̢͝l̶̨̛g̸̡͘o̵̢͠',
+    '\u200b\u200e\u202e',
+    'line 1\nline 2\n\nline 4',
+    'A' * 4096,
+    '/start@bot',
+    '/help',
+    '/settings',
+    '/cancel',
+    '/unknown_command',
+    '/',
+)
+
+
+def load_corpus(path):
+    """one input per line, escapes like \\n are unescaped"""
+    with open(path, encoding='utf-8') as f:
+        return [line.rstrip('\n').encode('utf-8').decode('unicode_escape').encode('latin-1').decode('utf-8')
+                for line in f if line.strip()]
+
+
+def accepts_text(state):
+    """states waiting for typed text: a reply keyboard or no keyboard at all, not inline menus"""
+    return (state.status == 'ok'
+            and state.parent is not None
+            and not any(action.kind == 'inline_button' for action in state.actions_out)
+            # the bot has moved on to the next message of the same reply
+            and not any(child.action_in is None for child in state.children))
+
+
+class FuzzReport:
+    """response classes per fuzzed state, with the inputs that produced them"""
+
+    def __init__(self):
+        self.states = []
+
+    def add_state(self, state):
+        entry = {'state_id': state.state_id, 'path': describe_path(state), 'classes': [], 'unreachable': False}
+        self.states.append(entry)
+        return entry
+
+    def to_dict(self):
+        return {
+            'summary': {
+                'states': len(self.states),
+                'inputs': sum(len(response_class['inputs'])
+                              for entry in self.states for response_class in entry['classes']),
+                'classes': sum(len(entry['classes']) for entry in self.states),
+            },
+            'states': self.states,
+        }
+
+    def save(self, filename=None):
+        if filename is None:
+            filename = f"fuzz_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2, ensure_ascii=False)
+        return filename
+
+
+class FuzzStage:
+    """
+    sends a corpus of text inputs to the text-accepting states of an explored tree.
+
+    states is a list of states or a predicate, accepts_text() by default. explore explores the
+    new response classes further with the tester's strategy and budgets.
+    """
+
+    def __init__(self, tester, corpus=DEFAULT_CORPUS, states=accepts_text, explore=True):
+        self.tester = tester
+        self.corpus = list(corpus)
+        self.states = states
+        self.explore = explore
+        self.report = FuzzReport()
+
+    def _targets(self):
+        if callable(self.states):
+            # results of fuzzing are not fuzzed again
+            return [state for state in self.tester.index.query()
+                    if self.states(state)
+                    and not (state.action_in is not None and state.action_in.kind == 'send_random_text_message')]
+        return list(self.states)
+
+    async def run(self):
+        tester = self.tester
+        tester._run_started_at = time.monotonic()
+        tester.stop_reason = None
+        tester._actions_at_start = tester.metrics.counters.get('actions', 0)
+        try:
+            for state in self._targets():
+                await self.fuzz_state(state)
+        except BudgetExhausted:
+            pass
+        finally:
+            tester._run_started_at = None
+
+        if self.explore and not tester.stop_reason:
+            await tester.explore_frontier()
+        return self.report
+
+    async def fuzz_state(self, state):
+        tester = self.tester
+        entry = self.report.add_state(state)
+        # responses of this state seen so far, the representative probe of a class -> the class
+        equivalence = tester.equivalence.clone()
+        classes = {}
+        errors = {}
+        for text in self.corpus:
+            if tester.current_state.state_id != state.state_id:
+                if not await tester.restore_state(state):
+                    entry['unreachable'] = True
+                    return
+
+            tester._spend_action()
+            action = await ActionFactory.create_action(kind='send_random_text_message', client=tester, text=text)
+            try:
+                probes = await action(restored=True)
+            except RPCError as e:
+                # e.g. MESSAGE_EMPTY or MESSAGE_TOO_LONG: rejected by Telegram, the bot never saw it
+                tester.current_action_update_buffer = []
+                if e.ID in errors:
+                    errors[e.ID]['inputs'].append(text)
+                else:
+                    errors[e.ID] = self._add_class(entry, {'error': e.ID}, text, None)
+                continue
+            tester.metrics.inc('fuzz_inputs')
+
+            response = probes[-1]
+            # no answer or the same keyboard: the bot still waits for input, the next one needs no restore
+            stayed = response.status == 'Timeout' or response.layout == state.layout
+            known = equivalence.find(response)
+            if known is not None:
+                classes[known]['inputs'].append(text)
+                if not stayed:
+                    # somewhere the tree doesn't know, the next input restores the state first
+                    tester.current_state = tester.root
+                continue
+
+            new_states = await self._materialize(state, action, probes)
+            equivalence.add(response)
+            classes[response] = self._add_class(
+                entry,
+                [{'text': probe.text, 'keyboard': [button for _, button in probe.layout], 'status': probe.status}
+                 for probe in probes],
+                text,
+                new_states[0].state_id,
+            )
+            tester.metrics.inc('fuzz_classes')
+            last = new_states[-1]
+            if stayed:
+                continue
+            tester.current_state = last
+            if tester._is_expandable(last, state):
+                tester._expand(last)
+
+    @staticmethod
+    def _add_class(entry, response, text, state_id):
+        response_class = {'response': response, 'inputs': [text], 'state_id': state_id}
+        entry['classes'].append(response_class)
+        return response_class
+
+    async def _materialize(self, state, action, probes):
+        """turns the probes of a new response class into states of the tree"""
+        tester = self.tester
+        # the input becomes an action of the state, so the new states can be restored like any other
+        state.actions_out.append(action)
+        tester._explored_by_depth[state.depth] = tester._explored_by_depth.get(state.depth, 0) + 1
+        new_states = [state]
+        for i, probe in enumerate(probes):
+            new_state = await StateNode.create(
+                tester,
+                parent=new_states[-1],
+                action_in=action if i == 0 else None,
+                result=probe.message if probe.message is not None else 'Timeout',
+            )
+            tester._observe_state(new_state)
+            new_states.append(new_state)
+        return new_states[1:]
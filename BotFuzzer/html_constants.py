@@ -0,0 +1,194 @@
+REPORT_CHUNK_SIZE = 500
+THUMBNAIL_SIZE = 256
+MAX_LABEL_LEN = 60
+
+# data files are JSONP, browsers don't allow fetch() on file:// pages but do load scripts
+REPORT_DATA = """BotFuzzer.loaded({}, {}, {});
+"""
+
+REPORT_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+  body {{ font-family: Helvetica, Arial, sans-serif; margin: 0; display: flex; height: 100vh; }}
+  #left {{ width: 50%; overflow: auto; padding: 8px; border-right: 1px solid #ccc; box-sizing: border-box; }}
+  #right {{ width: 50%; overflow: auto; padding: 8px; box-sizing: border-box; }}
+  #search {{ position: sticky; top: 0; background: #fff; padding-bottom: 6px; }}
+  ul {{ list-style: none; padding-left: 16px; margin: 0; }}
+  li > span {{ cursor: pointer; white-space: nowrap; }}
+  .toggle {{ display: inline-block; width: 14px; color: #888; }}
+  .selected {{ background: #dae8fc; }}
+  .status-Timeout {{ color: #b85450; }}
+  .status-Loop\\! {{ color: #d79b00; }}
+  .status-local {{ color: #888; }}
+  .status-Duplicate {{ color: #888; }}
+  pre {{ white-space: pre-wrap; background: #f5f5f5; padding: 6px; }}
+  #results div {{ cursor: pointer; padding: 2px 0; }}
+</style>
+</head>
+<body>
+<div id="left">
+  <div id="search">
+    <input id="query" placeholder="search text" size="30">
+    <select id="status"><option value="">any status</option></select>
+    <button id="go">Search</button> <span id="summary"></span>
+    <div id="results"></div>
+  </div>
+  <ul id="tree"></ul>
+</div>
+<div id="right">select a state</div>
+<script>
+var BotFuzzer = {{
+  chunkSize: {chunk_size},
+  waiting: {{}},
+  chunks: {{}},
+  loaded: function (kind, key, data) {{
+    if (kind === 'tree') {{ this.tree = data; this.init(); return; }}
+    if (kind === 'chunk') {{ this.chunks[key] = data; }}
+    if (kind === 'search') {{ this.search = data; }}
+    var callbacks = this.waiting[kind + key] || [];
+    delete this.waiting[kind + key];
+    callbacks.forEach(function (callback) {{ callback(data); }});
+  }},
+  load: function (kind, key, src, callback) {{
+    var id = kind + key;
+    if (this.waiting[id]) {{ this.waiting[id].push(callback); return; }}
+    this.waiting[id] = [callback];
+    var script = document.createElement('script');
+    script.src = src;
+    document.body.appendChild(script);
+  }},
+  details: function (i, callback) {{
+    var key = Math.floor(i / this.chunkSize);
+    var offset = i % this.chunkSize;
+    if (this.chunks[key]) {{ callback(this.chunks[key][offset]); return; }}
+    this.load('chunk', key, 'chunks/chunk_' + key + '.js', function (chunk) {{ callback(chunk[offset]); }});
+  }},
+  init: function () {{
+    var tree = this.tree, n = tree.parents.length;
+    this.children = new Array(n);
+    for (var i = 0; i < n; i++) {{ this.children[i] = null; }}
+    for (var i = 1; i < n; i++) {{
+      var p = tree.parents[i];
+      (this.children[p] = this.children[p] || []).push(i);
+    }}
+    var select = document.getElementById('status');
+    tree.statuses.forEach(function (status, code) {{
+      var option = document.createElement('option');
+      option.value = code; option.textContent = status;
+      select.appendChild(option);
+    }});
+    this.items = {{}};
+    document.getElementById('tree').appendChild(this.item(0));
+    this.expand(0);
+    var self = this;
+    document.getElementById('go').onclick = function () {{ self.find(); }};
+    document.getElementById('query').onkeydown = function (e) {{ if (e.key === 'Enter') self.find(); }};
+  }},
+  item: function (i) {{
+    var self = this, tree = this.tree;
+    var li = document.createElement('li');
+    var span = document.createElement('span');
+    var status = tree.statuses[tree.status[i]];
+    span.className = 'status-' + status;
+    span.innerHTML = '<span class="toggle">' + (this.children[i] ? '+' : '') + '</span>';
+    span.appendChild(document.createTextNode(tree.ids[i] + ' ' + (tree.labels[i] || '(bot message)') + ' [' + status + ']'));
+    span.onclick = function () {{ self.toggle(i); self.show(i); }};
+    li.appendChild(span);
+    this.items[i] = li;
+    return li;
+  }},
+  expand: function (i) {{
+    var li = this.items[i];
+    if (!this.children[i] || li.childNodes.length > 1) return;
+    // child elements are only created when a state is expanded
+    var ul = document.createElement('ul');
+    var self = this;
+    this.children[i].forEach(function (child) {{ ul.appendChild(self.item(child)); }});
+    li.appendChild(ul);
+    li.firstChild.firstChild.textContent = '-';
+  }},
+  toggle: function (i) {{
+    var li = this.items[i];
+    if (li.childNodes.length > 1) {{ li.removeChild(li.lastChild); li.firstChild.firstChild.textContent = '+'; }}
+    else {{ this.expand(i); }}
+  }},
+  reveal: function (i) {{
+    var path = [];
+    for (var p = this.tree.parents[i]; p >= 0; p = this.tree.parents[p]) path.unshift(p);
+    var self = this;
+    path.forEach(function (p) {{ self.expand(p); }});
+    this.items[i].scrollIntoView({{block: 'center'}});
+    this.show(i);
+  }},
+  show: function (i) {{
+    var self = this;
+    if (this.selected !== undefined && this.items[this.selected]) this.items[this.selected].firstChild.classList.remove('selected');
+    this.selected = i;
+    this.items[i].firstChild.classList.add('selected');
+    this.details(i, function (state) {{
+      var right = document.getElementById('right');
+      right.innerHTML = '';
+      var h = document.createElement('h3');
+      h.textContent = 'State ' + state.id + ' [' + self.tree.statuses[self.tree.status[i]] + ']';
+      right.appendChild(h);
+      var action = document.createElement('div');
+      action.textContent = 'action_in: ' + (self.tree.labels[i] || 'None');
+      right.appendChild(action);
+      var text = document.createElement('pre');
+      text.textContent = state.text;
+      right.appendChild(text);
+      if (state.thumbnail) {{
+        var img = document.createElement('img');
+        img.src = state.thumbnail;
+        right.appendChild(img);
+      }} else if (state.media) {{
+        var link = document.createElement('a');
+        link.href = state.media; link.textContent = 'Open File';
+        right.appendChild(link);
+      }}
+      var actions = document.createElement('ul');
+      state.actions_out.forEach(function (a) {{
+        var li = document.createElement('li');
+        li.textContent = a;
+        actions.appendChild(li);
+      }});
+      right.appendChild(actions);
+    }});
+  }},
+  find: function () {{
+    var self = this;
+    if (!this.search) {{ this.load('search', '', 'search.js', function () {{ self.find(); }}); return; }}
+    var words = document.getElementById('query').value.toLowerCase().match(/[\\p{{L}}\\p{{N}}_]+/gu) || [];
+    var status = document.getElementById('status').value;
+    var found = null;
+    words.forEach(function (word) {{
+      var postings = Object.prototype.hasOwnProperty.call(self.search, word) ? self.search[word] : [];
+      if (found === null) {{ found = postings.slice(); return; }}
+      var set = {{}};
+      postings.forEach(function (i) {{ set[i] = true; }});
+      found = found.filter(function (i) {{ return set[i]; }});
+    }});
+    if (found === null) {{
+      found = [];
+      for (var i = 0; i < this.tree.parents.length; i++) found.push(i);
+    }}
+    if (status !== '') found = found.filter(function (i) {{ return self.tree.status[i] === +status; }});
+    document.getElementById('summary').textContent = found.length + ' states';
+    var results = document.getElementById('results');
+    results.innerHTML = '';
+    found.slice(0, 200).forEach(function (i) {{
+      var div = document.createElement('div');
+      div.textContent = self.tree.ids[i] + ' ' + (self.tree.labels[i] || '(bot message)');
+      div.onclick = function () {{ self.reveal(i); }};
+      results.appendChild(div);
+    }});
+  }}
+}};
+</script>
+<script src="tree.js"></script>
+</body>
+</html>
+"""
@@ -0,0 +1,131 @@
+import re
+
+from layout import preorder
+
+TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """lowercase words of a state text, the unit of text search"""
+    return set(TOKEN.findall(str(text or '').lower()))
+
+
+class StateIndex:
+    """
+    secondary indexes over explored states: by status, action_in text and kind, text tokens and depth.
+
+    Tester keeps one up to date while exploring, StateIndex.build() indexes a loaded or exported tree.
+    Queries return states ordered by state_id.
+    """
+
+    def __init__(self):
+        self._states = {}
+        self._by_status = {}
+        self._by_action_text = {}
+        self._by_action_kind = {}
+        self._by_token = {}
+        self._by_depth = {}
+
+    @classmethod
+    def build(cls, root):
+        index = cls()
+        for state in preorder(root):
+            index.add(state)
+        return index
+
+    def add(self, state):
+        if state.state_id in self._states:
+            self.remove(state)
+        self._states[state.state_id] = state
+        self._by_status.setdefault(state.status, set()).add(state.state_id)
+        self._by_depth.setdefault(state.depth, set()).add(state.state_id)
+        if state.action_in is not None:
+            self._by_action_text.setdefault(str(state.action_in.text), set()).add(state.state_id)
+            self._by_action_kind.setdefault(state.action_in.kind, set()).add(state.state_id)
+        for token in tokenize(state.text):
+            self._by_token.setdefault(token, set()).add(state.state_id)
+
+    def remove(self, state):
+        state = self._states.pop(state.state_id, None)
+        if state is None:
+            return
+        self._discard(self._by_status, state.status, state.state_id)
+        self._discard(self._by_depth, state.depth, state.state_id)
+        if state.action_in is not None:
+            self._discard(self._by_action_text, str(state.action_in.text), state.state_id)
+            self._discard(self._by_action_kind, state.action_in.kind, state.state_id)
+        for token in tokenize(state.text):
+            self._discard(self._by_token, token, state.state_id)
+
+    def set_status(self, state, status):
+        """changes the status of an indexed state, e.g. to 'Loop!'"""
+        self._discard(self._by_status, state.status, state.state_id)
+        state.status = status
+        if state.state_id in self._states:
+            self._by_status.setdefault(status, set()).add(state.state_id)
+
+    def by_status(self, status):
+        return self.query(status=status)
+
+    def by_action(self, text=None, kind=None):
+        return self.query(action_text=text, action_kind=kind)
+
+    def by_depth(self, depth):
+        return self.query(depth=depth)
+
+    def search(self, words):
+        """states whose text contains all words"""
+        return self.query(words=words)
+
+    def query(self, status=None, action_text=None, action_kind=None, depth=None, words=None, pattern=None):
+        """
+        states matching all given conditions.
+
+        words must all occur in the text, pattern is a regular expression searched in the text of the
+        states left after the indexed conditions.
+        """
+        conditions = [
+            (self._by_status, status),
+            (self._by_action_text, action_text),
+            (self._by_action_kind, action_kind),
+            (self._by_depth, depth),
+        ]
+        if words is not None:
+            words = tokenize(words) if isinstance(words, str) else {str(word).lower() for word in words}
+            conditions.extend((self._by_token, word) for word in words)
+
+        # intersected from the smallest set, rare keys make the query cheap
+        id_sets = sorted((postings.get(key, set()) for postings, key in conditions if key is not None), key=len)
+        candidates = None
+        for ids in id_sets:
+            candidates = set(ids) if candidates is None else candidates & ids
+            if not candidates:
+                return []
+
+        if candidates is None:
+            candidates = self._states.keys()
+        states = [self._states[state_id] for state_id in sorted(candidates)]
+        if pattern is not None:
+            regex = re.compile(pattern) if isinstance(pattern, str) else pattern
+            states = [state for state in states if regex.search(str(state.text or ''))]
+        return states
+
+    def count(self, **conditions):
+        return len(self.query(**conditions))
+
+    def statuses(self):
+        return {status: len(ids) for status, ids in self._by_status.items() if ids}
+
+    @staticmethod
+    def _discard(postings, key, state_id):
+        ids = postings.get(key)
+        if ids is not None:
+            ids.discard(state_id)
+            if not ids:
+                del postings[key]
+
+    def __contains__(self, state):
+        return self._states.get(state.state_id) is state
+
+    def __len__(self):
+        return len(self._states)
@@ -0,0 +1,91 @@
+"""
+Iterative JSON serialization of state trees.
+
+write_tree() produces exactly what anytree's JsonExporter produced with indent=2 (nested states with a
+'children' list), but walks the tree with an explicit stack and writes to a stream state by state, so deep
+and large trees need neither recursion nor a copy of the whole tree as dicts. write_flat() writes states as
+one list of records referring to their parent by state_id, one record per line; orjson is used for it
+when installed.
+"""
+import json
+from json.encoder import encode_basestring
+
+from media import media_path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CHILDREN_SKIPPED = ("_NodeMixin__children", "_NodeMixin__parent")
+
+
+def node_attrs(node):
+    """attributes of a state as exported: stringified, brackets stripped, actions_out last"""
+    attrs = []
+    actions_out = None
+    for key, value in node.__dict__.items():
+        if key in CHILDREN_SKIPPED:
+            continue
+        if key == "media":
+            value = media_path(value)
+        value = str(value).strip("[]")
+        if key == "actions_out":
+            actions_out = value
+        else:
+            attrs.append((key, value))
+    if actions_out is not None:
+        attrs.append(("actions_out", actions_out))
+    return attrs
+
+
+def write_tree(root, stream):
+    """writes the nested form of the tree rooted at root"""
+    write = stream.write
+    # a stack of states still to write, with the separator in front of them and their indent, and of closing brackets
+    stack = [(root, '', '')]
+    while stack:
+        entry = stack.pop()
+        if isinstance(entry, str):
+            write(entry)
+            continue
+        node, prefix, indent = entry
+        fields = [f'{indent}  {encode_basestring(key)}: {encode_basestring(value)}' for key, value in node_attrs(node)]
+        children = node.children
+        if not children:
+            write(f'{prefix}{{\n' + ',\n'.join(fields) + f'\n{indent}}}' if fields else f'{prefix}{{}}')
+            continue
+
+        fields.append(f'{indent}  "children": [\n')
+        write(f'{prefix}{{\n' + ',\n'.join(fields))
+        stack.append(f'\n{indent}  ]\n{indent}}}')
+        child_indent = indent + '    '
+        for i in range(len(children) - 1, -1, -1):
+            stack.append((children[i], child_indent if i == 0 else f',\n{child_indent}', child_indent))
+
+
+def _dumps(record):
+    if orjson is not None:
+        try:
+            return orjson.dumps(record).decode('utf-8')
+        except TypeError:
+            # e.g. lone surrogates in a text, which json writes escaped
+            pass
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+
+
+def write_flat(root, stream):
+    """writes {"format": "flat", "states": [...]}, every state with the state_id of its parent"""
+    write = stream.write
+    write('{"format":"flat","states":[')
+    separator = '\n'
+    # preorder with an explicit stack, anytree's PreOrderIter recurses
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        record = {'parent': None if node is root else str(node.parent.state_id).strip("[]")}
+        record.update(node_attrs(node))
+        write(separator + _dumps(record))
+        separator = ',\n'
+        stack.extend(reversed(node.children))
+    write('\n]}\n')
@@ -0,0 +1,120 @@
+"""
+Tidy layout of drawio trees.
+
+Tables of one depth share a column and a parent is centered on its children, as before, but sibling subtrees
+are no longer stacked in bands of their own: Reingold-Tilford style, they are pushed together as close as their
+contours allow, the topmost and bottommost table of every column of a subtree. A shallow subtree next to a
+deep one takes the space the deep one leaves free. Subtrees are laid out once, bottom up, contours are merged
+smaller into larger, so the layout takes linear time, and nothing recurses, so trees of any depth lay out.
+"""
+from xml_constants import BASE_START_TABLE_X_AXIS, BASE_TABLE_WIDTH, MARGIN
+
+
+class Contour:
+    """
+    vertical extent of a subtree per column, relative to the top of its root table.
+
+    Columns are stored deepest first, so a parent adds its own column at the end of the contour of its children,
+    and every stored value is off by offset, so shifting the whole subtree costs nothing.
+    """
+    __slots__ = ('levels', 'offset')
+
+    def __init__(self, height):
+        self.levels = [[0, height]]
+        self.offset = 0
+
+    def __len__(self):
+        return len(self.levels)
+
+    def top(self, level):
+        return self.levels[-1 - level][0] + self.offset
+
+    def bottom(self, level):
+        return self.levels[-1 - level][1] + self.offset
+
+    def add_root(self, height):
+        self.levels.append([-self.offset, height - self.offset])
+
+    def extent(self):
+        return (min(top for top, _ in self.levels) + self.offset,
+                max(bottom for _, bottom in self.levels) + self.offset)
+
+
+def separation(upper, lower):
+    """how far lower is shifted down to be below upper by MARGIN in every column they share"""
+    return max(upper.bottom(level) + MARGIN - lower.top(level) for level in range(min(len(upper), len(lower))))
+
+
+def merge(upper, lower, shift):
+    """contour of both subtrees, lower shifted down by shift; the longer contour is reused"""
+    common = min(len(upper), len(lower))
+    if len(lower) > len(upper):
+        lower.offset += shift
+        for level in range(common):
+            lower.levels[-1 - level][0] = upper.top(level) - lower.offset
+        return lower
+    for level in range(common):
+        upper.levels[-1 - level][1] = lower.bottom(level) + shift - upper.offset
+    return upper
+
+
+def preorder(root):
+    nodes = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(reversed(node.children))
+    return nodes
+
+
+def layout_tree(root, y_position):
+    """
+    places the tables of the tree rooted at root, its topmost table at y_position.
+
+    Tables need table_height, rows and children; table_x, table_y and row_y are set. Returns the y position
+    below the tree, where the next tree of a page starts.
+    """
+    nodes = preorder(root)
+    contours = {}
+    # y of the top of a table relative to the top of its parent
+    offsets = {}
+    # reversed preorder: children are laid out before their parent
+    for node in reversed(nodes):
+        children = node.children
+        if not children:
+            contours[id(node)] = Contour(node.table_height)
+            continue
+
+        # children relative to the top of the first one
+        positions = [0]
+        merged = contours.pop(id(children[0]))
+        for child in children[1:]:
+            contour = contours.pop(id(child))
+            shift = separation(merged, contour)
+            positions.append(shift)
+            merged = merge(merged, contour, shift)
+
+        node_top = (positions[-1] + children[-1].table_height) / 2 - node.table_height / 2
+        for child, position in zip(children, positions):
+            offsets[id(child)] = position - node_top
+        merged.offset -= node_top
+        merged.add_root(node.table_height)
+        contours[id(node)] = merged
+
+    top, bottom = contours[id(root)].extent()
+    root.table_y = y_position - top
+    depths = {id(root): 0}
+    for node in nodes:
+        depth = depths[id(node)]
+        if node is not root:
+            node.table_y = node.parent.table_y + offsets[id(node)]
+        node.table_x = BASE_START_TABLE_X_AXIS + depth * (BASE_TABLE_WIDTH + MARGIN)
+        current_row_y = 0
+        for row in node.rows:
+            row.row_y = current_row_y
+            current_row_y += row.row_height
+        for child in node.children:
+            depths[id(child)] = depth + 1
+
+    return y_position + bottom - top + MARGIN
@@ -18,9 +18,12 @@ async def main():
             traceback.print_exc()
             print(f'ERROR: {e}')
         finally:
-            tester.exporter.export_to_drawio(mode='tree')
-            tester.exporter.export_to_drawio(mode='matrix')
-            tester.exporter.export_to_json(save=True)
+            # the three formats are rendered in parallel from one snapshot of the tree
+            await asyncio.gather(
+                tester.exporter.submit('export_to_drawio', mode='tree'),
+                tester.exporter.submit('export_to_drawio', mode='matrix'),
+                tester.exporter.submit('save_json'),
+            )
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,162 @@
+"""
+Media downloads decoupled from state creation.
+
+A state with a photo or video is created right away with a PendingMedia handle, while the file is
+downloaded by a bounded pool shared by all bots of an account. Failed downloads are retried a few times,
+videos are converted to webp in a worker thread. Once the download is done the state's media becomes the
+file path; exports of the whole run wait for the downloads still pending first.
+"""
+import asyncio
+
+VIDEO_EXTENSIONS = ('mp4', 'avi', 'mov', 'MOV', 'webp')
+
+
+def convert_video_to_webp(filepath):
+    """writes the first 5 seconds of a video as an animated webp next to it, static webp images are skipped"""
+    # moviepy pulls in imageio and numpy, imported only when a bot actually sends a video
+    from PIL import Image, UnidentifiedImageError
+    from moviepy.editor import VideoFileClip
+
+    if filepath.lower().endswith('.webp'):
+        try:
+            with Image.open(filepath) as img:
+                if img.format == 'WEBP' and not getattr(img, "is_animated", False):
+                    # The file is a static WebP image; skip processing
+                    return
+        except UnidentifiedImageError:
+            pass
+
+    clip = VideoFileClip(filepath)
+    if clip.duration > 5:
+        clip = clip.subclip(0, 5)
+    fps = 10
+    frames = []
+
+    for frame in clip.iter_frames(fps=fps, dtype='uint8'):
+        img = Image.fromarray(frame)
+        img.thumbnail((512, 512))
+        frames.append(img)
+
+    new_filepath = filepath.rsplit('.', 1)[0] + '.webp'
+    frames[0].save(
+        new_filepath,
+        format='WEBP',
+        save_all=True,
+        append_images=frames[1:],
+        duration=int(1000 / fps),
+        loop=0
+    )
+
+
+class PendingMedia:
+    """
+    media of a state that is still being downloaded.
+
+    Awaiting it gives the file path, or None if there was nothing to download. A bound state gets the
+    path as its media once the download is done; until then exports write None, see media_path().
+    """
+
+    def __init__(self, task):
+        self.task = task
+
+    def bind(self, state):
+        def resolve(task):
+            if state.media is self:
+                state.media = None if task.cancelled() else task.result()
+        self.task.add_done_callback(resolve)
+
+    def done(self):
+        return self.task.done()
+
+    def result(self):
+        """the file path if the download is done, None otherwise"""
+        if not self.task.done() or self.task.cancelled() or self.task.exception() is not None:
+            return None
+        return self.task.result()
+
+    def __await__(self):
+        return self.task.__await__()
+
+    def __repr__(self):
+        return '<pending media>'
+
+
+def media_path(media):
+    """media of a state as exports write it: the file path, None while the download is pending"""
+    if isinstance(media, PendingMedia):
+        return media.result()
+    return media
+
+
+class DownloadPool:
+    """
+    downloads media of messages in the background, at most workers at a time.
+
+    A download failing with a network or Telegram error is retried up to retries times with a growing
+    delay. FloodWait is waited out and doesn't count as a failed attempt. A message without downloadable
+    media resolves to None.
+    """
+
+    def __init__(self, client, workers=4, retries=2, retry_delay=1):
+        self.client = client
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._semaphore = asyncio.Semaphore(workers)
+        self._pending = set()
+
+    def submit(self, message, metrics, logger):
+        """starts the download of the media of message, returns a PendingMedia"""
+        task = asyncio.get_running_loop().create_task(self._process(message, metrics, logger))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return PendingMedia(task)
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    async def join(self):
+        """waits for all downloads submitted so far, and for the ones they submit meanwhile"""
+        while self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    async def _process(self, message, metrics, logger):
+        async with self._semaphore:
+            filepath = await self._download(message, metrics, logger)
+        # the conversion doesn't hold a download slot
+        if filepath is not None and filepath.endswith(VIDEO_EXTENSIONS):
+            try:
+                with metrics.timer('media_conversion'):
+                    await asyncio.get_running_loop().run_in_executor(None, convert_video_to_webp, filepath)
+            except Exception as e:
+                logger.warning(f"Error while converting {filepath}: {e!r}")
+        return filepath
+
+    async def _download(self, message, metrics, logger):
+        from pyrogram.errors import FloodWait, RPCError
+
+        attempt = 0
+        while True:
+            try:
+                with metrics.timer('media_download'):
+                    filepath = await self.client.download_media(message)
+            except ValueError as e:
+                logger.debug(f"Error while downloading media: {e}")
+                return None
+            except FloodWait as e:
+                # Telegram asks to slow down, the download itself didn't fail
+                metrics.inc('media_flood_waits')
+                await asyncio.sleep(e.value)
+                continue
+            except (OSError, asyncio.TimeoutError, RPCError) as e:
+                if attempt == self.retries:
+                    logger.warning(f"Media of message {getattr(message, 'id', None)} not downloaded: {e!r}")
+                    metrics.inc('media_download_errors')
+                    return None
+                metrics.inc('media_download_retries')
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+                attempt += 1
+                continue
+            metrics.inc('media_downloads')
+            return filepath
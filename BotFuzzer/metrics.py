@@ -0,0 +1,194 @@
+import asyncio
+import json
+import os
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60, 120, float('inf'))
+
+
+class Histogram:
+    """cumulative latency histogram in prometheus style"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'avg': round(self.sum / self.count, 6) if self.count else 0,
+            'max': round(self.max, 6),
+            'buckets': {
+                str(bound): count for bound, count in zip(self.buckets, self._cumulative())
+            },
+        }
+
+    def _cumulative(self):
+        total = 0
+        for count in self.bucket_counts:
+            total += count
+            yield total
+
+
+class Metrics:
+    """
+    counters and latency histograms of one run.
+
+    Counters: actions, states, restores, restore_failures, pipelined_restore_fallbacks, flood_waits,
+    timeouts, duplicates_pruned, sampled_out_actions, fuzz_inputs, fuzz_classes, llm_calls, media_downloads,
+    media_download_retries, media_download_errors, exports.
+    Histograms (seconds): action_duration, response_latency, sleep, flood_wait, restore_duration, llm_latency,
+    media_download, media_conversion, export_<mode>.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start)
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started_at
+        minutes = elapsed / 60 or 1
+        sleep_time = self._histogram_sum('sleep') + self._histogram_sum('flood_wait')
+        return {
+            'timestamp': time.time(),
+            'elapsed': round(elapsed, 3),
+            'actions_per_minute': round(self.counters.get('actions', 0) / minutes, 3),
+            'states_per_minute': round(self.counters.get('states', 0) / minutes, 3),
+            'sleep_time': round(sleep_time, 3),
+            'work_time': round(max(elapsed - sleep_time, 0), 3),
+            'counters': dict(self.counters),
+            'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+        }
+
+    def to_prometheus(self, prefix='botfuzzer'):
+        lines = []
+        snapshot = self.snapshot()
+        for gauge in ('elapsed', 'actions_per_minute', 'states_per_minute', 'sleep_time', 'work_time'):
+            lines.append(f'# TYPE {prefix}_{gauge} gauge')
+            lines.append(f'{prefix}_{gauge} {snapshot[gauge]}')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines.append(f'{prefix}_{name}_total {value}')
+        for name, histogram in sorted(self.histograms.items()):
+            metric = f'{prefix}_{name}_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            for bound, count in zip(histogram.buckets, histogram._cumulative()):
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f'{metric}_bucket{{le="{le}"}} {count}')
+            lines.append(f'{metric}_sum {histogram.sum}')
+            lines.append(f'{metric}_count {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path, extra=None):
+        snapshot = self.snapshot()
+        if extra:
+            snapshot.update(extra)
+        # write to a temporary file first so readers never see a half-written file
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(tmp_path, path)
+
+    async def report_periodically(self, path, interval, extra=None):
+        while True:
+            await asyncio.sleep(interval)
+            self.write_json(path, extra() if extra else None)
+
+    async def start_http_server(self, host='127.0.0.1', port=9464):
+        return await asyncio.start_server(self._handle_http, host, port)
+
+    async def _handle_http(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # drain headers, the request body is never used
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            path = parts[1] if len(parts) > 1 else '/'
+
+            if path == '/metrics':
+                status, content_type, body = '200 OK', 'text/plain; version=0.0.4', self.to_prometheus()
+            elif path == '/metrics.json':
+                status, content_type, body = '200 OK', 'application/json', json.dumps(self.snapshot())
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', 'not found\n'
+
+            payload = body.encode('utf-8')
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                f'Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + payload
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def _histogram_sum(self, name):
+        histogram = self.histograms.get(name)
+        return histogram.sum if histogram else 0.0
+
+
+class Profiler:
+    """opt-in profiler wrapping a whole run, kind is 'cprofile' or 'pyinstrument'"""
+
+    def __init__(self, kind='cprofile', output=None):
+        if kind not in ('cprofile', 'pyinstrument'):
+            raise ValueError(f"Unknown profiler: {kind}")
+        self.kind = kind
+        self.output = output or ('botfuzzer.prof' if kind == 'cprofile' else 'botfuzzer_profile.html')
+        self._profiler = None
+
+    def start(self):
+        if self.kind == 'cprofile':
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            from pyinstrument import Profiler as PyinstrumentProfiler
+            self._profiler = PyinstrumentProfiler(async_mode='enabled')
+            self._profiler.start()
+
+    def stop(self):
+        if self._profiler is None:
+            return None
+        if self.kind == 'cprofile':
+            self._profiler.disable()
+            self._profiler.dump_stats(self.output)
+        else:
+            self._profiler.stop()
+            with open(self.output, 'w', encoding='utf-8') as f:
+                f.write(self._profiler.output_html())
+        self._profiler = None
+        return self.output
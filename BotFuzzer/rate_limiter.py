@@ -0,0 +1,30 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    """
+    account-level pacing of requests, shared by all bots explored over one client.
+
+    requests_per_minute spreads requests evenly, None disables pacing. A FloodWait received
+    by any bot pauses all of them, since Telegram counts requests per account.
+    """
+
+    def __init__(self, requests_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self._next_request_at = 0.0
+        self._resume_at = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            wait = max(self._next_request_at, self._resume_at) - now
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        if self.requests_per_minute:
+            # reserved before anyone else wakes up, so concurrent sessions queue up one after another
+            self._next_request_at = time.monotonic() + 60 / self.requests_per_minute
+
+    def pause(self, seconds):
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
@@ -0,0 +1,359 @@
+"""
+Incremental regression runs.
+
+A previous run's tree (exported with export_to_json) is loaded and every known state is revisited
+in depth-first order, so consecutive checks reuse the state the bot is already in. Only subtrees
+whose text, keyboard or status changed, and actions that didn't exist before, are explored fully.
+"""
+import json
+import re
+import time
+from datetime import datetime
+
+from StateNode import StateNode, TYPED_INPUT_KINDS
+from actions import RecordedAction
+
+ACTION_KINDS = ('send_text_message', 'send_random_text_message', 'send_ai_text_message', 'inline_button')
+_ACTION_SPLIT = re.compile(r', (?=(?:%s): )' % '|'.join(ACTION_KINDS))
+_ACTION = re.compile(r'^(%s): (.*)$' % '|'.join(ACTION_KINDS), re.S)
+
+
+def parse_action(value):
+    if value in (None, '', 'None'):
+        return None
+    match = _ACTION.match(value)
+    if match is None:
+        return RecordedAction(None, value)
+    return RecordedAction(match.group(1), match.group(2))
+
+
+def parse_actions(value):
+    if not value:
+        return []
+    return [parse_action(part) for part in _ACTION_SPLIT.split(value)]
+
+
+def state_from_record(record, parent):
+    """StateNode with RecordedActions from the exported attributes of a state"""
+    media = record.get('media')
+    return StateNode(
+        int(record['state_id']),
+        parent=parent,
+        action_in=parse_action(record.get('action_in')),
+        text=record.get('text', ''),
+        media=None if media in (None, 'None') else media,
+        actions_out=parse_actions(record.get('actions_out')),
+        status=record.get('status', 'ok'),
+    )
+
+
+def tree_from_dict(data):
+    """builds a StateNode tree with RecordedActions from the output of export_to_json"""
+    root = None
+    stack = [(data, None)]
+    while stack:
+        node_data, parent = stack.pop()
+        node = state_from_record(node_data, parent)
+        if root is None:
+            root = node
+        # reversed, so children are attached to the parent in their original order
+        for child_data in reversed(node_data.get('children', [])):
+            stack.append((child_data, node))
+    return root
+
+
+def tree_from_flat(data):
+    """builds a StateNode tree from the output of export_to_json(flat=True)"""
+    root = None
+    nodes = {}
+    # states are listed in preorder, a parent always comes before its children
+    for record in data['states']:
+        parent = record['parent']
+        node = state_from_record(record, nodes[parent] if parent is not None else None)
+        nodes[record['state_id']] = node
+        if root is None:
+            root = node
+    return root
+
+
+def load_tree(path):
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    return tree_from_flat(data) if data.get('format') == 'flat' else tree_from_dict(data)
+
+
+def action_repr(action):
+    # the json exporter strips brackets from every value, compare in that form
+    return repr(action).strip('[]')
+
+
+def fingerprint(state):
+    """text, keyboard and status of a state as they appear in an exported tree"""
+    return (
+        str(state.text).strip('[]'),
+        tuple(action_repr(action) for action in state.actions_out if action.kind not in TYPED_INPUT_KINDS),
+        state.status,
+    )
+
+
+def reproduces(state, probe):
+    """whether a replayed message has the text and keyboard of a state of the previous tree"""
+    return str(state.text).strip('[]') == str(probe.text).strip('[]') and state.layout == probe.layout
+
+
+def passive_chain(state):
+    """state and the extra messages the bot sent after it in reply to the same action"""
+    chain = [state]
+    while True:
+        passive = next((child for child in chain[-1].children if child.action_in is None), None)
+        if passive is None:
+            return chain
+        chain.append(passive)
+
+
+def index_subtree(root):
+    """maps the path of actions from root to every state of the subtree"""
+    index = {(): root}
+    stack = [(root, ())]
+    while stack:
+        node, path = stack.pop()
+        occurrences = {}
+        for child in node.children:
+            if child.action_in is not None and child.action_in.kind in TYPED_INPUT_KINDS:
+                # typed inputs are not offered by the bot and not compared
+                continue
+            key = action_repr(child.action_in) if child.action_in is not None else None
+            occurrences[key] = occurrences.get(key, 0) + 1
+            child_path = path + ((key, occurrences[key]),)
+            index[child_path] = child
+            stack.append((child, child_path))
+    return index
+
+
+def describe_path(state):
+    return ' > '.join(action_repr(node.action_in) for node in state.path if node.action_in is not None)
+
+
+def describe_state(state):
+    return {
+        'state_id': state.state_id,
+        'path': describe_path(state),
+        'text': state.text,
+        'actions_out': [action_repr(action) for action in state.actions_out],
+        'status': state.status,
+    }
+
+
+class TreeDiff:
+    """structured difference between a previous and the current tree"""
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.changed = []
+        self.unverified = []
+        self.unchanged = 0
+        # why the run stopped early, e.g. a budget ran out, None if it checked everything
+        self.stop_reason = None
+
+    def add_subtree(self, previous, current):
+        """compares two subtrees that were both explored fully"""
+        previous_index = index_subtree(previous) if previous is not None else {}
+        current_index = index_subtree(current) if current is not None else {}
+        for path, state in current_index.items():
+            previous_state = previous_index.get(path)
+            if previous_state is None:
+                self.added.append(state)
+            elif fingerprint(previous_state) != fingerprint(state):
+                self.changed.append((previous_state, state))
+            else:
+                self.unchanged += 1
+        for path, state in previous_index.items():
+            if path not in current_index:
+                self.removed.append(state)
+
+    def to_dict(self):
+        return {
+            'summary': {
+                'added': len(self.added),
+                'removed': len(self.removed),
+                'changed': len(self.changed),
+                'unverified': len(self.unverified),
+                'unchanged': self.unchanged,
+                'stop_reason': self.stop_reason,
+            },
+            'added': [describe_state(state) for state in self.added],
+            'removed': [describe_state(state) for state in self.removed],
+            'changed': [
+                {'previous': describe_state(previous), 'current': describe_state(current)}
+                for previous, current in self.changed
+            ],
+            'unverified': [describe_state(state) for state in self.unverified],
+        }
+
+    def save(self, filename=None):
+        if filename is None:
+            filename = f"diff_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2, ensure_ascii=False)
+        return filename
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+
+class RegressionRunner:
+    """
+    re-verifies a previous tree against the live bot and re-explores only what changed.
+
+    explore_unvisited also explores actions that were known in the previous run but never
+    performed, e.g. because of max_depth or a budget, which turns the run into a resume.
+    """
+
+    def __init__(self, tester, previous_root, explore_unvisited=False):
+        self.tester = tester
+        self.previous_root = previous_root
+        self.explore_unvisited = explore_unvisited
+        self.diff = TreeDiff()
+        self._reexplored = []
+        self._new_actions = []
+
+    @classmethod
+    def from_file(cls, tester, path, explore_unvisited=False):
+        return cls(tester, load_tree(path), explore_unvisited=explore_unvisited)
+
+    async def run(self):
+        from Tester import BudgetExhausted
+
+        tester = self.tester
+        live_root = tester.root
+        tester._observe_state(live_root)
+        tester._expanded_states.add(live_root)
+        # budgets of the tester cover verification and exploration together
+        tester._run_started_at = time.monotonic()
+        tester.stop_reason = None
+        tester._actions_at_start = tester.metrics.counters.get('actions', 0)
+
+        # depth-first: a verified state is checked further right away, before the bot leaves it
+        stack = []
+        self._check_actions(self.previous_root, live_root, stack)
+        try:
+            while stack:
+                previous_child, live_parent, action_index = stack.pop()
+                await self._verify(previous_child, live_parent, action_index, stack)
+        except BudgetExhausted:
+            self.diff.unverified.append(previous_child)
+            self.diff.unverified.extend(previous for previous, _, _ in reversed(stack))
+            tester._run_started_at = None
+            tester.tester_logger.info(f"Regression run stopped: {tester.stop_reason}")
+            await tester.downloads.join()
+        else:
+            await tester.explore_frontier(continue_run=True)
+        self.diff.stop_reason = tester.stop_reason if tester.stop_reason != 'frontier is empty' else None
+
+        for previous, current in self._reexplored:
+            self.diff.add_subtree(previous, current)
+        for live, key in self._new_actions:
+            for child in live.children:
+                if child.action_in is not None and action_repr(child.action_in) == key:
+                    self.diff.add_subtree(None, child)
+        return self.diff
+
+    def _check_actions(self, previous, live, stack):
+        previous_edges = {}
+        for child in previous.children:
+            if child.action_in is not None and child.action_in.kind not in TYPED_INPUT_KINDS:
+                previous_edges.setdefault(action_repr(child.action_in), []).append(child)
+        known_actions = {action_repr(action) for action in previous.actions_out}
+
+        edges = []
+        for i, action in enumerate(live.actions_out):
+            key = action_repr(action)
+            if action.kind in TYPED_INPUT_KINDS:
+                # AI text is generated anew on every run and fuzz inputs are typed by a fuzz stage,
+                # neither is offered by the bot, there is nothing to compare them with
+                continue
+            if not action.mutating:
+                # answered locally, compared without contacting the bot
+                previous_child = previous_edges[key].pop(0) if previous_edges.get(key) else None
+                local_state = action.annotate(live)
+                # indexed and counted like in Explorer._expand
+                self.tester._observe_state(local_state)
+                self.tester._explored_by_depth[live.depth] = self.tester._explored_by_depth.get(live.depth, 0) + 1
+                self._reexplored.append((previous_child, local_state))
+                continue
+            if previous_edges.get(key):
+                edges.append((previous_edges[key].pop(0), live, i))
+            elif key not in known_actions:
+                self.tester.tester_logger.info(f"New action {key} in state {describe_path(live) or 'root'}")
+                self.tester.strategy.push_action(live, i)
+                self._new_actions.append((live, key))
+            elif self.explore_unvisited:
+                self.tester.strategy.push_action(live, i)
+
+        for children in previous_edges.values():
+            for child in children:
+                self._reexplored.append((child, None))
+
+        stack.extend(reversed(edges))
+
+    async def _verify(self, previous_child, live_parent, action_index, stack):
+        tester = self.tester
+        if tester.current_state.state_id != live_parent.state_id and not await tester.restore_state(live_parent):
+            tester._unreachable_states.add(live_parent)
+            self.diff.unverified.append(previous_child)
+            return
+
+        # the action is replayed like a restore step: a probe per message, compared by text and keyboard,
+        # so unchanged states cost no LLM calls and no media downloads
+        tester._spend_action()
+        action = live_parent.actions_out[action_index]
+        probes = await action(restored=True)
+        previous_chain = passive_chain(previous_child)
+        reproduced = (len(previous_chain) == len(probes)
+                      and all(reproduces(previous, probe) for previous, probe in zip(previous_chain, probes)))
+        result_of_action = await self._create_states(live_parent, action, probes, previous_chain if reproduced else None)
+        tester._record_result(live_parent, result_of_action)
+
+        live_end = result_of_action[-1]
+        expandable = tester._is_expandable(live_end, live_parent)
+        same = reproduced and all(fingerprint(previous) == fingerprint(live)
+                                  for previous, live in zip(previous_chain, result_of_action))
+
+        if same:
+            self.diff.unchanged += len(result_of_action)
+            if expandable:
+                tester._expanded_states.add(live_end)
+                self._check_actions(previous_chain[-1], live_end, stack)
+            else:
+                # e.g. below max_depth now: what the previous run found there is not checked again
+                self.diff.unverified.extend(child for child in previous_chain[-1].children
+                                            if child.action_in.kind not in TYPED_INPUT_KINDS)
+            return
+
+        tester.tester_logger.info(f"State changed: {describe_path(previous_child)}")
+        self._reexplored.append((previous_child, result_of_action[0]))
+        if expandable:
+            tester._expand(live_end)
+
+    async def _create_states(self, live_parent, action, probes, previous_chain):
+        """
+        turns the probes of a verified action into states of the live tree.
+
+        States reproducing previous_chain are created as on a restore, without AI actions and downloads,
+        and keep the media of the previous run; changed states (previous_chain None) are created in full.
+        """
+        tester = self.tester
+        states = [live_parent]
+        for i, probe in enumerate(probes):
+            state = await StateNode.create(
+                tester,
+                parent=states[-1],
+                action_in=action if i == 0 else None,
+                result=probe.message if probe.message is not None else 'Timeout',
+                restored=previous_chain is not None,
+            )
+            if previous_chain is not None:
+                state.media = previous_chain[i].media
+            states.append(state)
+        return states[1:]
@@ -0,0 +1,136 @@
+import re
+
+NUMBER = re.compile(r'\d+')
+# ids, hashes and tokens inside callback data: long runs of letters mixed with digits
+IDENTIFIER = re.compile(r'\b(?=[A-Za-z_-]*\d)[\w-]{8,}\b')
+
+
+def button_class(action):
+    """
+    class of a button: buttons of one class are expected to lead to alike states.
+
+    Callback buttons are classed by the pattern of their callback_data, other buttons by the shape
+    of their text, with numbers and ids replaced by placeholders.
+    """
+    callback_data = getattr(action, 'callback_data', None)
+    if callback_data:
+        if isinstance(callback_data, bytes):
+            callback_data = callback_data.decode('utf-8', 'replace')
+        return action.kind, 'data', NUMBER.sub('#', IDENTIFIER.sub('*', callback_data))
+    return action.kind, 'text', NUMBER.sub('#', str(action.text))
+
+
+def response_of(states):
+    """what a button led to: the keyboard of the last state or probe, or a timeout"""
+    state = states[-1]
+    return ('Timeout',) if state.status == 'Timeout' else state.layout
+
+
+class ButtonClass:
+    def __init__(self, key):
+        self.key = key
+        self.responses = set()
+        self.explored = 0
+        self.heterogeneous = False
+        self.sampled_out = []
+
+
+class ButtonSampler:
+    """
+    equivalence-class sampling of large keyboards, e.g. catalogs with dozens of product buttons.
+
+    Buttons of a keyboard are grouped by button_class(). Classes larger than sample_per_class + spot_check
+    are sampled: their first sample_per_class buttons to leave the frontier are explored fully, then only
+    spot_check buttons spread over the rest of the keyboard are pressed, as a probe without new states, and
+    compared with the responses of the class. The class is shared by all keyboards, so later pages of a
+    paginated menu are only spot-checked. As soon as two buttons of a class lead to different keyboards the
+    class is split up, and its sampled out buttons, the differing spot check included, are explored after all.
+    """
+
+    def __init__(self, sample_per_class, spot_check=1):
+        self.sample_per_class = sample_per_class
+        self.spot_check = spot_check
+        self._classes = {}
+        # (state_id, action_index) -> (class, is spot check)
+        self._plan = {}
+
+    def plan(self, state, action_indices):
+        groups = {}
+        for i in action_indices:
+            groups.setdefault(button_class(state.actions_out[i]), []).append(i)
+
+        for key, indices in groups.items():
+            if len(indices) <= self.sample_per_class + self.spot_check:
+                continue
+            button_class_ = self._classes.setdefault(key, ButtonClass(key))
+            rest = indices[self.sample_per_class:]
+            # evenly spread over the rest, the last button included: last pages and items often differ
+            step = len(rest) / self.spot_check if self.spot_check else 0
+            spot_checks = {rest[len(rest) - 1 - int(j * step)] for j in range(self.spot_check)}
+            for i in indices:
+                self._plan[(state.state_id, i)] = (button_class_, i in spot_checks)
+
+    def should_explore(self, item):
+        planned = self._plan.get((item.state.state_id, item.action_index))
+        if planned is None:
+            return True
+        button_class_, spot_check = planned
+        if button_class_.heterogeneous or button_class_.explored < self.sample_per_class:
+            return True
+        if not spot_check:
+            button_class_.sampled_out.append(item)
+        return False
+
+    def is_spot_check(self, item):
+        """a button not explored, only pressed to compare its response with its class"""
+        planned = self._plan.get((item.state.state_id, item.action_index))
+        return planned is not None and planned[1]
+
+    def record(self, item, result_of_action):
+        """
+        records the response of an explored button.
+
+        Returns the sampled out items to explore after all, when the response splits the class.
+        """
+        planned = self._plan.pop((item.state.state_id, item.action_index), None)
+        if planned is None or not result_of_action:
+            return []
+        button_class_ = planned[0]
+        button_class_.explored += 1
+        button_class_.responses.add(response_of(result_of_action))
+        if button_class_.heterogeneous or len(button_class_.responses) == 1:
+            return []
+        button_class_.heterogeneous = True
+        released, button_class_.sampled_out = button_class_.sampled_out, []
+        return released
+
+    def record_spot_check(self, item, probes):
+        """
+        records the response of a spot check, probes of the messages the button led to.
+
+        Returns the items to explore after all, the spot check itself included, when the response is
+        unlike the responses of the class.
+        """
+        button_class_ = self._plan.pop((item.state.state_id, item.action_index))[0]
+        response = response_of(probes)
+        if response in button_class_.responses:
+            button_class_.sampled_out.append(item)
+            return []
+        button_class_.responses.add(response)
+        button_class_.heterogeneous = True
+        released, button_class_.sampled_out = button_class_.sampled_out, []
+        return released + [item]
+
+    def sampled_out(self):
+        return [item for button_class_ in self._classes.values() for item in button_class_.sampled_out]
+
+    def classes(self):
+        """explored buttons, distinct responses and sampled out buttons per class"""
+        return {
+            ':'.join(map(str, key)): {
+                'explored': button_class_.explored,
+                'responses': len(button_class_.responses),
+                'sampled_out': len(button_class_.sampled_out),
+            }
+            for key, button_class_ in self._classes.items()
+        }
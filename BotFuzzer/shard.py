@@ -0,0 +1,407 @@
+"""
+Sharded exploration of one bot by several processes.
+
+The coordinator owns the merged state tree and hands out subtrees to workers. A subtree is identified
+by its restoration path, the actions leading from the root to its state, and is explored by a worker
+down to shard_depth levels below it. States on that boundary become new subtrees. Every worker runs
+its own Tester with its own Telegram session, so workers may run on several hosts:
+
+    python BotFuzzer/shard.py coordinator --host 0.0.0.0 --port 8765 --max-depth 6 --shard-depth 2
+    python BotFuzzer/shard.py worker --host 10.0.0.1 --port 8765 --target-bot @my_bot --name TesterBot1
+
+Workers and the coordinator exchange one JSON object per line over TCP. A subtree is merged only once
+its worker reported all of it, and children are ordered by the keyboard of their parent before the
+tree is saved, so the result doesn't depend on which worker finished first. Media files are sent along
+with their states and saved by the coordinator; a file too large to send stays on its worker and the
+state's media tells which worker has it.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+from collections import deque
+
+from StateNode import StateNode
+from actions import RecordedAction
+
+STREAM_LIMIT = 16 * 1024 * 1024
+# base64 grows a file by a third, larger files would not fit into one message
+MAX_SENT_MEDIA = 8 * 1024 * 1024
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov')
+
+
+async def read_message(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+async def write_message(writer, message):
+    writer.write((json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8'))
+    await writer.drain()
+
+
+def action_key(action):
+    if action is None:
+        return None, None
+    return action.kind, str(action.text)
+
+
+def restoration_path(state):
+    """actions leading from the root to state, passive states are skipped as no action leads to them"""
+    return [list(action_key(node.action_in)) for node in state.path[1:] if node.action_in is not None]
+
+
+def media_record(media, worker):
+    """
+    the media file of a state as sent to the coordinator: its name and base64 content, or, for a file
+    too large to send, the worker it stays on and its path there. Videos are sent as the webp exports show.
+    """
+    if not isinstance(media, str):
+        return None
+    filepath = media
+    if media.lower().endswith(VIDEO_EXTENSIONS) and os.path.exists(media.rsplit('.', 1)[0] + '.webp'):
+        filepath = media.rsplit('.', 1)[0] + '.webp'
+    if not os.path.exists(filepath) or os.path.getsize(filepath) > MAX_SENT_MEDIA:
+        return {'worker': worker, 'path': media}
+    with open(filepath, 'rb') as f:
+        return {'name': os.path.basename(filepath), 'data': base64.b64encode(f.read()).decode('ascii')}
+
+
+def subtree_records(state, worker=None):
+    """states of the subtree in preorder, each with its path of (kind, text, occurrence) steps from state"""
+    stack = [(state, [])]
+    while stack:
+        node, path = stack.pop()
+        yield {
+            'path': path,
+            'text': node.text,
+            'media': media_record(node.media, worker),
+            'status': node.status,
+            'actions_out': [list(action_key(action)) for action in node.actions_out],
+        }
+        occurrences = {}
+        children = []
+        for child in node.children:
+            key = action_key(child.action_in)
+            occurrences[key] = occurrences.get(key, 0) + 1
+            children.append((child, path + [[*key, occurrences[key]]]))
+        stack.extend(reversed(children))
+
+
+class ShardTask:
+    def __init__(self, task_id, state, max_depth):
+        self.task_id = task_id
+        self.state = state
+        self.max_depth = max_depth
+        self.attempts = 0
+
+    def to_message(self):
+        return {
+            'type': 'task',
+            'task_id': self.task_id,
+            'path': restoration_path(self.state),
+            'max_depth': self.max_depth,
+        }
+
+    def __repr__(self):
+        return f'task {self.task_id}: {" > ".join(f"{kind}: {text}" for kind, text in restoration_path(self.state))}'
+
+
+class ShardCoordinator:
+    """owns the merged tree, hands out subtrees to connected workers until none are left"""
+
+    def __init__(self, host='127.0.0.1', port=8765, max_depth=5, shard_depth=2, max_attempts=2,
+                 media_dir='downloads'):
+        self.host = host
+        self.port = port
+        self.media_dir = media_dir
+        self.max_depth = max_depth
+        self.shard_depth = shard_depth
+        self.max_attempts = max_attempts
+        self.logger = logging.getLogger('ShardCoordinator')
+
+        self.total = 0
+        self.root = StateNode(0, actions_out=[])
+        self.failed = []
+        self._task_ids = 0
+        self._pending = deque()
+        self._in_flight = {}
+        self._condition = asyncio.Condition()
+        self._finished = asyncio.Event()
+
+    async def run(self):
+        self._pending.append(self._new_task(self.root))
+        server = await asyncio.start_server(self._handle_worker, self.host, self.port, limit=STREAM_LIMIT)
+        self.logger.info(f'Coordinator is listening on {self.host}:{self.port}')
+        async with server:
+            await self._finished.wait()
+        self.finalize()
+        self.logger.info(f'Exploration finished: {self.total + 1} states, {len(self.failed)} failed subtrees')
+        return self.root
+
+    def finalize(self):
+        """orders children by the keyboard of their parent and renumbers states in preorder"""
+        stack = [self.root]
+        state_id = 0
+        while stack:
+            node = stack.pop()
+            node.state_id = state_id
+            state_id += 1
+            node.children = sorted(node.children, key=lambda child: self._child_order(node, child))
+            stack.extend(reversed(node.children))
+
+    @staticmethod
+    def _child_order(parent, child):
+        if child.action_in is None:
+            return -1
+        for i, action in enumerate(parent.actions_out):
+            if action == child.action_in:
+                return i
+        return len(parent.actions_out)
+
+    def _new_task(self, state):
+        self._task_ids += 1
+        return ShardTask(self._task_ids, state, min(state.depth + self.shard_depth, self.max_depth))
+
+    async def _next_task(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._pending or self._finished.is_set())
+            if self._pending:
+                task = self._pending.popleft()
+                self._in_flight[task.task_id] = task
+                return task
+            return None
+
+    async def _complete(self, task, records=None, error=None):
+        async with self._condition:
+            self._in_flight.pop(task.task_id, None)
+            if error is None:
+                self._merge(task, records)
+            else:
+                task.attempts += 1
+                if task.attempts < self.max_attempts:
+                    self.logger.info(f'{task} failed: {error}, retrying')
+                    self._pending.append(task)
+                else:
+                    self.logger.info(f'{task} failed: {error}, giving up')
+                    self.failed.append(task)
+            if not self._pending and not self._in_flight:
+                self._finished.set()
+            self._condition.notify_all()
+
+    async def _handle_worker(self, reader, writer):
+        hello = await read_message(reader)
+        name = (hello or {}).get('worker', 'unknown')
+        self.logger.info(f'Worker {name} connected')
+        task = None
+        try:
+            while True:
+                task = await self._next_task()
+                if task is None:
+                    await write_message(writer, {'type': 'stop'})
+                    break
+                self.logger.info(f'{task} -> worker {name}')
+                await write_message(writer, task.to_message())
+
+                # buffered, a subtree is merged only when it is complete
+                records = []
+                while True:
+                    message = await read_message(reader)
+                    if message is None:
+                        raise ConnectionError(f'worker {name} disconnected')
+                    if message['type'] == 'state':
+                        records.append(message)
+                    elif message['type'] == 'done':
+                        break
+                await self._complete(task, records, message.get('error'))
+                task = None
+        except (ConnectionError, json.JSONDecodeError) as e:
+            self.logger.info(f'Worker {name} is lost: {e}')
+            if task is not None:
+                await self._complete(task, error=str(e))
+        finally:
+            writer.close()
+
+    def _merge(self, task, records):
+        nodes = {(): task.state}
+        for record in records:
+            path = tuple(tuple(step) for step in record['path'])
+            if not path:
+                # the state of the task itself is already known, except the actions of the very first root
+                if task.state is self.root:
+                    self.root.actions_out = [RecordedAction(*key) for key in record['actions_out']]
+                continue
+            kind, text, _ = path[-1]
+            self.total += 1
+            node = StateNode(
+                self.total,
+                parent=nodes[path[:-1]],
+                action_in=RecordedAction(kind, text) if kind is not None else None,
+                text=record['text'],
+                media=self._save_media(record['media']),
+                actions_out=[RecordedAction(*key) for key in record['actions_out']],
+                status=record['status'],
+            )
+            nodes[path] = node
+
+        for node in nodes.values():
+            if node is not task.state and self._is_boundary(node, task):
+                self._pending.append(self._new_task(node))
+        self.logger.info(f'{task} merged: {len(records) - 1} states, {len(self._pending)} subtrees pending')
+
+    def _save_media(self, media):
+        """path of a received media file, or remote:<worker>:<path> for a file that stayed on its worker"""
+        if media is None:
+            return None
+        if 'data' not in media:
+            return f"remote:{media['worker']}:{media['path']}"
+        os.makedirs(self.media_dir, exist_ok=True)
+        # names of downloads are unique per worker only
+        filepath = os.path.join(self.media_dir, f"{self.total}_{media['name']}")
+        with open(filepath, 'wb') as f:
+            f.write(base64.b64decode(media['data']))
+        return filepath
+
+    def _is_boundary(self, node, task):
+        """state the worker didn't expand only because of the depth of its task"""
+        if (node.depth < task.max_depth or node.depth >= self.max_depth
+                or node.status != 'ok' or not node.actions_out):
+            return False
+        if any(child.action_in is None for child in node.children):
+            # not the last message of the answer, actions are performed from the last one
+            return False
+        source = node
+        while source.action_in is None and source.parent is not None:
+            source = source.parent
+        return source.parent is None or node != source.parent
+
+
+class ShardWorker:
+    """explores subtrees handed out by a coordinator with its own Tester"""
+
+    def __init__(self, tester, host='127.0.0.1', port=8765):
+        self.tester = tester
+        self.host = host
+        self.port = port
+
+    async def run(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port, limit=STREAM_LIMIT)
+        try:
+            await write_message(writer, {'type': 'hello', 'worker': self.tester.name})
+            while True:
+                message = await read_message(reader)
+                if message is None or message['type'] == 'stop':
+                    break
+                await self._run_task(message, writer)
+        finally:
+            writer.close()
+
+    async def _run_task(self, task, writer):
+        tester = self.tester
+        tester.tester_logger.info(f"Task {task['task_id']}: {task['path']}")
+        await tester.reset_tree()
+        tester.max_depth = task['max_depth']
+
+        state, error = await self._replay(task['path'])
+        if state is None:
+            await write_message(writer, {'type': 'done', 'task_id': task['task_id'], 'error': error})
+            return
+
+        await tester.test(target_node=state)
+        for record in subtree_records(state, tester.name):
+            await write_message(writer, {'type': 'state', 'task_id': task['task_id'], **record})
+        await write_message(writer, {'type': 'done', 'task_id': task['task_id']})
+
+    async def _replay(self, path):
+        """performs the restoration path, returns the reached state or None and the reason"""
+        state = self.tester.root
+        for kind, text in path:
+            index = self._find_action(state, kind, text)
+            if index is None:
+                return None, f'no action {kind}: {text} in state {state.text[:50]!r}'
+            result_of_action = await self.tester._perform_action(state, index)
+            if result_of_action is None or result_of_action[-1].status != 'ok':
+                return None, f'action {kind}: {text} did not lead to the expected state'
+            state = result_of_action[-1]
+        return state, None
+
+    @staticmethod
+    def _find_action(state, kind, text):
+        for i, action in enumerate(state.actions_out):
+            # AI text differs on every run, any AI action of the state stands for it
+            if action.kind == kind and (kind == 'send_ai_text_message' or str(action.text) == text):
+                return i
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Sharded BotFuzzer exploration')
+    subparsers = parser.add_subparsers(dest='role', required=True)
+
+    coordinator = subparsers.add_parser('coordinator', help='hand out subtrees and merge the results')
+    coordinator.add_argument('--host', default='127.0.0.1')
+    coordinator.add_argument('--port', type=int, default=8765)
+    coordinator.add_argument('--max-depth', type=int, default=5)
+    coordinator.add_argument('--shard-depth', type=int, default=2, help='levels explored by a worker per task')
+    coordinator.add_argument('--max-attempts', type=int, default=2, help='attempts per subtree before giving up')
+    coordinator.add_argument('--output', default=None, help='JSON file of the merged tree')
+    coordinator.add_argument('--media-dir', default='downloads', help='directory of media files sent by workers')
+    coordinator.add_argument('--drawio', action='store_true', help='also export the merged tree to drawio')
+
+    worker = subparsers.add_parser('worker', help='explore subtrees with one Telegram session')
+    worker.add_argument('--host', default='127.0.0.1')
+    worker.add_argument('--port', type=int, default=8765)
+    worker.add_argument('--target-bot', required=True)
+    worker.add_argument('--name', default='TesterBot', help='pyrogram session name, one per worker')
+    worker.add_argument('--min-time-to-wait', type=float, default=5)
+    worker.add_argument('--max-time-to-wait', type=float, default=10)
+    worker.add_argument('--in-memory-session', action='store_true')
+    worker.add_argument('--debug', action='store_true')
+    return parser.parse_args(argv)
+
+
+async def run_coordinator(args):
+    from export import Exporter
+
+    coordinator = ShardCoordinator(args.host, args.port, max_depth=args.max_depth,
+                                   shard_depth=args.shard_depth, max_attempts=args.max_attempts,
+                                   media_dir=args.media_dir)
+    root = await coordinator.run()
+    exporter = Exporter(root)
+    exporter.save_json(args.output)
+    if args.drawio:
+        exporter.export_to_drawio(mode='tree')
+    return 1 if coordinator.failed else 0
+
+
+async def run_worker(args):
+    from Tester import Tester
+
+    tester = await Tester.create(
+        target_bot=args.target_bot,
+        name=args.name,
+        min_time_to_wait=args.min_time_to_wait,
+        max_time_to_wait=args.max_time_to_wait,
+        debug=args.debug,
+        in_memory_session=args.in_memory_session,
+        log_file=f'yaml_logs_{args.name}.yaml',
+    )
+    async with tester:
+        await ShardWorker(tester, args.host, args.port).run()
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.role == 'coordinator':
+        return asyncio.run(run_coordinator(args))
+    return asyncio.run(run_worker(args))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,158 @@
+"""
+Configurable equivalence of states.
+
+By default two states are equal when their keyboards are, the text is ignored. Bots with counters,
+timestamps, balances or usernames in their messages, or with paginated menus, need more: texts are
+normalized by rules, and states are compared exactly or by a SimHash of their text and keyboard.
+Near duplicates are looked up in an LSH index, in constant time per state.
+"""
+import hashlib
+import re
+
+DEFAULT_RULES = (
+    (r'https?://\S+', '<url>'),
+    (r'[\w.+-]+@[\w-]+\.[\w.]+', '<email>'),
+    (r'@\w+', '<user>'),
+    (r'\d{1,4}[./-]\d{1,2}[./-]\d{1,4}', '<date>'),
+    (r'\d{1,2}:\d{2}(:\d{2})?', '<time>'),
+    (r'\d+([.,]\d+)*', '<num>'),
+    (r'\s+', ' '),
+)
+
+
+class TextNormalizer:
+    """replaces dynamic parts of a text (urls, usernames, dates, times, numbers) by placeholders"""
+
+    def __init__(self, rules=DEFAULT_RULES, lowercase=True):
+        self.rules = [(re.compile(pattern), replacement) for pattern, replacement in rules]
+        self.lowercase = lowercase
+
+    def __call__(self, text):
+        text = str(text or '')
+        for pattern, replacement in self.rules:
+            text = pattern.sub(replacement, text)
+        text = text.strip()
+        return text.lower() if self.lowercase else text
+
+
+def _feature_hash(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def simhash(features, bits=64):
+    """SimHash of weighted features: similar feature sets give hashes with a small hamming distance"""
+    weights = [0] * bits
+    for feature, weight in features:
+        value = _feature_hash(feature)
+        for bit in range(bits):
+            weights[bit] += weight if value >> bit & 1 else -weight
+    result = 0
+    for bit in range(bits):
+        if weights[bit] > 0:
+            result |= 1 << bit
+    return result
+
+
+class SimHashIndex:
+    """
+    LSH index of SimHashes.
+
+    The hash is cut into bands; hashes within max_distance bits share at least one band exactly when
+    bands > max_distance, so candidates are found by a few dict lookups instead of pairwise comparison.
+    """
+
+    def __init__(self, bits=64, bands=4, max_distance=3):
+        if bands <= max_distance:
+            raise ValueError("bands must be greater than max_distance")
+        self.bits = bits
+        self.bands = bands
+        self.max_distance = max_distance
+        self._band_bits = bits // bands
+        self._buckets = [{} for _ in range(bands)]
+
+    def _band_keys(self, value):
+        mask = (1 << self._band_bits) - 1
+        return [(value >> (band * self._band_bits)) & mask for band in range(self.bands)]
+
+    def find(self, value):
+        """an item stored with a hash within max_distance bits of value, or None"""
+        for bucket, key in zip(self._buckets, self._band_keys(value)):
+            for stored_value, item in bucket.get(key, ()):
+                if bin(stored_value ^ value).count('1') <= self.max_distance:
+                    return item
+        return None
+
+    def add(self, value, item):
+        for bucket, key in zip(self._buckets, self._band_keys(value)):
+            bucket.setdefault(key, []).append((value, item))
+
+
+class StateEquivalence:
+    """
+    decides which states are the same.
+
+    mode 'keyboard' compares keyboards only (the default behaviour of StateNode), 'normalized' also
+    compares normalized texts, 'similar' compares SimHashes of the normalized text and the keyboard.
+    """
+    MODES = ('keyboard', 'normalized', 'similar')
+
+    def __init__(self, mode='keyboard', normalizer=None, max_distance=3, bands=4, keyboard_weight=2):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown state equivalence: {mode}")
+        self.mode = mode
+        self.normalizer = normalizer or TextNormalizer()
+        self.max_distance = max_distance
+        self.bands = bands
+        self.keyboard_weight = keyboard_weight
+        self._known = {}
+        self._similar = SimHashIndex(bands=bands, max_distance=max_distance) if mode == 'similar' else None
+
+    @classmethod
+    def create(cls, equivalence):
+        if isinstance(equivalence, StateEquivalence):
+            return equivalence
+        return cls(equivalence)
+
+    def key(self, state):
+        if self.mode == 'keyboard':
+            return state.layout
+        if self.mode == 'normalized':
+            return self.normalizer(state.text), state.layout
+        return self.simhash(state)
+
+    def simhash(self, state):
+        words = self.normalizer(state.text).split()
+        features = [(word, 1) for word in words]
+        features += [(f'{first} {second}', 1) for first, second in zip(words, words[1:])]
+        features += [(f'button:{kind}:{text}', self.keyboard_weight) for kind, text in state.layout]
+        return simhash(features)
+
+    def equal(self, first, second):
+        if self.mode == 'keyboard':
+            return first == second
+        if self.mode == 'normalized':
+            return self.key(first) == self.key(second)
+        return bin(self.key(first) ^ self.key(second)).count('1') <= self.max_distance
+
+    def find(self, state):
+        """an already added state equivalent to state, or None"""
+        key = self.key(state)
+        if self._similar is not None:
+            return self._similar.find(key)
+        return self._known.get(key)
+
+    def add(self, state):
+        key = self.key(state)
+        if self._similar is not None:
+            self._similar.add(key, state)
+        else:
+            self._known.setdefault(key, state)
+
+    def reset(self):
+        self._known = {}
+        if self._similar is not None:
+            self._similar = SimHashIndex(bands=self.bands, max_distance=self.max_distance)
+
+    def clone(self):
+        """the same rules without the added states, for another bot"""
+        return type(self)(self.mode, self.normalizer, self.max_distance, self.bands, self.keyboard_weight)
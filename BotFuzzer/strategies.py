@@ -0,0 +1,177 @@
+import heapq
+import itertools
+from collections import deque
+
+
+class FrontierItem:
+    """not yet performed action of an explored state"""
+
+    def __init__(self, state, action_index):
+        self.state = state
+        # index, not the action itself: restores replace actions of a state with fresh ones
+        self.action_index = action_index
+
+    @property
+    def action(self):
+        return self.state.actions_out[self.action_index]
+
+    def __repr__(self):
+        return f'{self.state.state_id}: {self.action}'
+
+
+class ExplorationStrategy:
+    """
+    frontier of (state, action) pairs waiting to be explored.
+
+    Subclasses decide in which order pairs leave the frontier.
+    """
+    name = None
+
+    def push_state(self, state, action_indices=None):
+        if action_indices is None:
+            action_indices = range(len(state.actions_out))
+        self._push([FrontierItem(state, i) for i in action_indices])
+
+    def push_action(self, state, action_index):
+        self._push([FrontierItem(state, action_index)])
+
+    def pop(self):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def items(self):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def observe(self, state):
+        """called for every state created during exploration"""
+
+    def clear(self):
+        """drops all pairs and what was learned from observed states, for a new tree"""
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def _push(self, items):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def __len__(self):
+        raise NotImplementedError("Subclasses must implement this method")
+
+
+class DFSStrategy(ExplorationStrategy):
+    """depth-first search, the order of the original recursive exploration"""
+    name = 'dfs'
+
+    def __init__(self):
+        self._stack = []
+
+    def _push(self, items):
+        # reversed, so the first action of the state is popped first
+        self._stack.extend(reversed(items))
+
+    def pop(self):
+        return self._stack.pop()
+
+    def clear(self):
+        self._stack = []
+
+    def items(self):
+        return list(self._stack)
+
+    def __len__(self):
+        return len(self._stack)
+
+
+class BFSStrategy(ExplorationStrategy):
+    """breadth-first search, explores all states of a depth before going deeper"""
+    name = 'bfs'
+
+    def __init__(self):
+        self._queue = deque()
+
+    def _push(self, items):
+        self._queue.extend(items)
+
+    def pop(self):
+        return self._queue.popleft()
+
+    def clear(self):
+        self._queue.clear()
+
+    def items(self):
+        return list(self._queue)
+
+    def __len__(self):
+        return len(self._queue)
+
+
+class BestFirstStrategy(ExplorationStrategy):
+    """
+    novelty-driven search.
+
+    Pairs are ranked by how often the keyboard layout and the text of their state were seen,
+    how often the same action was already performed elsewhere, and by depth, so a limited
+    run spends its time on states unlike anything explored so far.
+    """
+    name = 'best_first'
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._layouts = {}
+        self._texts = {}
+        self._performed_actions = {}
+
+    def observe(self, state):
+        layout = state.layout
+        self._layouts[layout] = self._layouts.get(layout, 0) + 1
+        self._texts[state.text] = self._texts.get(state.text, 0) + 1
+
+    def score(self, item):
+        state = item.state
+        return (
+            self._layouts.get(state.layout, 0),
+            self._texts.get(state.text, 0),
+            self._performed_actions.get(item.action.key, 0),
+            state.depth,
+        )
+
+    def _push(self, items):
+        for item in items:
+            heapq.heappush(self._heap, (self.score(item), next(self._counter), item))
+
+    def pop(self):
+        while True:
+            score, _, item = heapq.heappop(self._heap)
+            # scores only grow while exploring, re-check lazily instead of re-scoring the whole heap
+            current_score = self.score(item)
+            if current_score == score or not self._heap or current_score <= self._heap[0][0]:
+                break
+            heapq.heappush(self._heap, (current_score, next(self._counter), item))
+
+        key = item.action.key
+        self._performed_actions[key] = self._performed_actions.get(key, 0) + 1
+        return item
+
+    def clear(self):
+        self._heap = []
+        self._layouts = {}
+        self._texts = {}
+        self._performed_actions = {}
+
+    def items(self):
+        return [item for _, _, item in sorted(self._heap)]
+
+    def __len__(self):
+        return len(self._heap)
+
+
+STRATEGIES = {
+    strategy.name: strategy for strategy in (DFSStrategy, BFSStrategy, BestFirstStrategy)
+}
+
+
+def create_strategy(strategy):
+    if isinstance(strategy, ExplorationStrategy):
+        return strategy
+    try:
+        return STRATEGIES[strategy]()
+    except KeyError:
+        raise ValueError(f"Unknown exploration strategy: {strategy}") from None
@@ -6,6 +6,11 @@ BASE_CELL_SHARE = 0.2
 MAX_STR_LEN = 1000
 FONT_PATH = 'BotFuzzer/Helvetica.ttf'
 FONT_SIZE = 30
+# collapse_chains: linear chains of at least this many states are drawn as one table
+MIN_FOLDED_CHAIN = 3
+FOLDED_TEXT_LEN = 60
+# states listed at the start and at the end of a folded chain
+FOLDED_LISTED = 10
 
 BASE_PAGE = """
 <mxfile host="65bd71144e">
@@ -45,3 +50,31 @@ BASE_EDGE = """
 \t\t\t\t  <mxGeometry relative="1" as="geometry" />
 \t\t\t\t</mxCell>
 """
+
+# multi-page export: one <diagram> per page, stubs link to the page a subtree continues on
+STUB_HEIGHT = 120
+
+BASE_FILE_START = """<mxfile host="65bd71144e">
+"""
+
+BASE_FILE_END = """</mxfile>
+"""
+
+BASE_DIAGRAM = """    <diagram id="{}" name="{}">
+        <mxGraphModel dx="642" dy="83" grid="0" gridSize="10" guides="1" tooltips="1" connect="1" arrows="1" fold="1" page="0" pageScale="1" pageWidth="850" pageHeight="1100" math="0" shadow="0">
+            <root>
+                <mxCell id="y"/>
+                <mxCell id="x" parent="y"/>
+                {}
+            </root>
+        </mxGraphModel>
+    </diagram>
+"""
+
+BASE_STUB = f"""
+\t\t\t\t<UserObject label="{{}}" link="{{}}" id="{{}}">
+\t\t\t\t  <mxCell style="rounded=1;whiteSpace=wrap;html=1;fontSize={FONT_SIZE};fillColor=#dae8fc;strokeColor=#6c8ebf;" parent="x" vertex="1">
+\t\t\t\t    <mxGeometry x="{{}}" y="{{}}" width="{{}}" height="{{}}" as="geometry" />
+\t\t\t\t  </mxCell>
+\t\t\t\t</UserObject>
+"""